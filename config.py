@@ -16,6 +16,9 @@ class Pokemon:
 class WarPoker:
     history = [[],[]]
 
+class Holdem:
+    history = [[],[]]
+
 #general settings
 
 #search
@@ -39,11 +42,21 @@ probCutoff = 0.03
 #how many games to play after training
 numTestGames = 10
 
+#distilling the old models into one strategy network per player, see runner.distill
+#number of self-play games to get infosets from, 0 to skip distillation
+distillGames = 0
+#fraction of the distillation infosets held out to measure how far the strategy networks are from the old models
+distillValSplit = 0.1
+#whether test games use the strategy networks instead of the old models
+#if distillGames is 0, the newest strategy networks are loaded from the save file
+playDistilled = False
+
 #general game config
 #gameName = 'warPoker'
+#gameName = 'holdem'
 gameName = 'pokemon'
 
-if gameName == 'warPoker':
+if gameName == 'warPoker' or gameName == 'holdem':
     game = games.warPoker
     GameConfig = WarPoker
 
@@ -60,6 +73,47 @@ if gameName == 'warPoker':
     resumeIter = None
     #number of game tree traversals per search iteration
     innerLoops = 1000
+    #have search processes take traversals from a shared counter instead of each doing innerLoops
+    #the total is still innerLoops per search process, but faster processes do more of them
+    #the counter is a TCPStore on schedulerPort, which has to be free
+    workStealing = False
+    #port for the shared counter's TCPStore, the process group uses 29500
+    schedulerPort = 29501
+    #number of traversals each search process runs at once
+    #traversals waiting on the network let other traversals run
+    numConcurrentTraversals = 8
+    #max number of network outputs each search process caches per player
+    #the networks don't change during an iteration, so repeated infosets can skip the net process
+    #0 to disable
+    predictCacheSize = 4096
+    #max number of on player states whose subtree value and samples are kept during an iteration
+    #a state seen again in the same iteration reuses them instead of traversing the subtree again
+    #the samples are only reused if nothing below is random, i.e. with samplingPolicy = 'fullWidth', offPlayerFullWidth, and no depthLimit
+    #otherwise only the value is reused, which is one sample of the subtree for every traversal that gets there
+    #not used with pipelineTraining
+    #only used if both players' infosets determine the game state (the game's infosetsDetermineState)
+    #0 to disable
+    transpositionTableSize = 0
+    #expand sibling subtrees at the same time instead of one after another
+    #only matters when more than one branch is taken, i.e. branchingLimit > 1, branchingLimit = None, or probing
+    concurrentExpansion = True
+    #number of extra game contexts for concurrent traversals and expansion, for games that can't fork
+    #warPoker forks games, so it doesn't need any
+    contextPoolSize = 0
+    #how on player actions are picked for expansion, see sampling.py
+    #'branching' uses branchingLimit and onExploreRate, 'fullWidth', 'pruning', 'robust', or 'average'
+    samplingPolicy = 'branching'
+    #with 'pruning', actions with a predicted advantage below this aren't expanded
+    pruneThreshold = -0.25
+    #odds of expanding a pruned action anyway, so its advantage can recover
+    pruneReexpandRate = 0.05
+    #with 'robust', number of actions sampled uniformly at each node
+    robustSampleSize = 1
+    #with 'average', sample odds are max(epsilon, (bonus + threshold * p) / (bonus + 1)) for each action
+    #so actions with p > 1 / threshold are always taken, and every action gets at least bonus / (bonus + 1)
+    averageThreshold = 2
+    averageBonus = 0.1
+    averageEpsilon = 0.05
     #limit on number of branches to take per action in a traversal
     #(branches not taken are still possibly probed via rollout)
     branchingLimit = 1
@@ -67,8 +121,14 @@ if gameName == 'warPoker':
     enableProbingRollout=True
     #maximum depth in a traversal before rollout
     depthLimit = None
+    #odds of using the value net at the depth limit instead of rolling out
+    #value net leaves skip the rest of the game, so they save a lot of simulator calls
+    valueLeafRate = 0
     #odds of the off player making a random move
     offExploreRate = 0
+    #traverse every off player action instead of sampling one, like vanilla cfr
+    #samples get weighted by the off player's odds of reaching them, so the training data matches sampling on average
+    offPlayerFullWidth = False
     #odds of the on player making a random move
     #only used if branchingLimit is not none
     onExploreRate = 0.2
@@ -76,9 +136,49 @@ if gameName == 'warPoker':
     progressGamesToRecord = 10
     progressGamePath = 'progress/'
 
+    #inference
+    #max number of requests the net process puts in one forward pass
+    maxBatchSize = 256
+    #max time the net process waits to fill a batch after the first request comes in
+    #with inferenceTransport = 'gloo', each header and input takes a few ms to come in when the machine is busy
+    #(about 3ms with 2 search processes on one core), so a batch rarely gets more than 2 or 3 requests in 500us
+    #with gloo, raise this to a few ms if batching matters more than latency, or use 'shm'
+    maxWaitMicros = 500
+    #how search processes send requests to the net process
+    #'gloo' sends everything through torch.distributed
+    #'shm' writes requests into shared memory rings, which skips gloo's per-message overhead
+    #the ring files are removed when the net process stops
+    inferenceTransport = 'gloo'
+    #prefix for the shared memory ring files, one pair per search process
+    shmPath = '/dev/shm/shallowred'
+    #number of requests each search process can have in its ring at once
+    shmSlots = 32
+    #longest infoset that fits in a ring slot, longer infosets go through gloo
+    shmMaxInfosetLength = 64
+    #max number of lstm states the net process caches per network, keyed by infoset prefix
+    #infosets in a traversal share prefixes, so only the new tokens have to go through the lstm
+    #only used when cnn and attention are disabled, 0 to disable
+    #warPoker infosets are only a few tokens, so there isn't much to save
+    prefixCacheSize = 0
+    #number of tokens between cached prefixes
+    prefixCacheChunk = 4
+    #also run every cached batch the normal way and complain if the outputs differ
+    verifyPrefixCache = False
+    #file the net process writes its metrics to as json, None to disable
+    telemetryPath = 'telemetry.json'
+    #seconds between telemetry writes
+    telemetryInterval = 10
+    #prefix for chrome trace files of where each process spends its time, one file per rank
+    #merge them with telemetry.mergeTraces, None to disable
+    tracePath = None
+
     #training
     #number of epochs for training the advantage network
     advEpochs = 500
+    #train the advantage network in the background while the search processes start the next iteration
+    #the search processes use the newest network that's finished training, which might be an iteration or two old
+    #the net process logs how stale the served networks were
+    pipelineTraining = False
     #number of epochs for training the strategy network
     stratEpochs = 5
     #maximum number of samples in an epoch
@@ -116,6 +216,12 @@ if gameName == 'warPoker':
     #enable an attention layer after the lstm
     enableAttention = False
 
+    #evaluate the old networks in getProbs with their lstm weights stacked, instead of one forward pass per network
+    #needs cnn and attention to be disabled
+    #the stacked lstm steps through time in python, which was slower than separate networks at pokemon sizes
+    #so only turn it on after measuring a speedup on the hardware you're using
+    groupedEnsemble = False
+
     #learn rate for training
     learnRate = 0.001 
     #which optimizer to use (adam or sgd)
@@ -140,6 +246,36 @@ if gameName == 'warPoker':
     }
 
 
+#holdem uses warPoker's settings, except for these
+if gameName == 'holdem':
+    #importing holdem builds its hand evaluator's tables, so only do it if we're playing holdem
+    import games.holdem
+    game = games.holdem
+    GameConfig = Holdem
+
+    #search
+    #hold'em has a lot more infosets than warPoker, so it needs a lot more traversals
+    innerLoops = 5000
+    #a probe plays out the rest of the hand, which is a lot longer than in warPoker
+    enableProbingRollout = False
+    #holdem infosets don't include the cards that haven't been dealt yet, so there's no transposition table
+
+    #inference
+    #the longest holdem infoset is about 50 tokens, which fits in shmMaxInfosetLength
+    #the infosets are long enough for the prefix cache to be worth it
+    prefixCacheSize = 4096
+    prefixCacheChunk = 8
+
+    #training
+    advEpochs = 300
+    epochMaxNumSamples = 200000
+    miniBatchSize = 2048
+
+    #model
+    embedSize = 32
+    lstmSize = 64
+    width = 64
+
 elif gameName == 'pokemon':
     game = games.pokemon
     GameConfig = Pokemon
@@ -153,6 +289,35 @@ elif gameName == 'pokemon':
     resumeIter = None
     #number of game tree traversals per search iteration
     innerLoops = 50
+    #have search processes take traversals from a shared counter instead of each doing innerLoops, see warPoker
+    workStealing = False
+    #port for the shared counter's TCPStore, the process group uses 29500
+    schedulerPort = 29501
+    #number of traversals each search process runs at once
+    #a PS process only runs one battle at a time, so with more than 1, each traversal checks out its own from the context pool
+    #and this shouldn't be more than contextPoolSize + 1
+    numConcurrentTraversals = 1
+    #max number of network outputs each search process caches per player, 0 to disable
+    predictCacheSize = 16384
+    #max number of on player states whose subtree value and samples are kept during an iteration, see warPoker
+    #pokemon infosets don't include the simulator's rng state, so two games with the same infosets can still differ, and this is ignored
+    transpositionTableSize = 0
+    #expand sibling subtrees at the same time instead of one after another
+    concurrentExpansion = True
+    #number of extra game contexts for concurrent traversals and expansion, for games that can't fork
+    #each one is another PS process per search process, so numProcesses * contextPoolSize more node processes and their memory
+    #concurrent traversals check these out along with the search process's main context, and expansion gets the rest
+    #this hasn't been measured against the extra processes yet, so it's off by default
+    #the search stats print how often expansion didn't find a free context
+    contextPoolSize = 0
+    #how on player actions are picked for expansion and the settings for each policy, see warPoker and sampling.py
+    samplingPolicy = 'branching'
+    pruneThreshold = -0.25
+    pruneReexpandRate = 0.05
+    robustSampleSize = 2
+    averageThreshold = 2
+    averageBonus = 0.1
+    averageEpsilon = 0.05
     #limit on number of branches to take per action in a traversal
     #(branches not taken are still possibly probed via rollout)
     branchingLimit = 1
@@ -160,8 +325,13 @@ elif gameName == 'pokemon':
     enableProbingRollout=False
     #maximum depth in a traversal before rollout
     depthLimit = 20
+    #odds of using the value net at the depth limit instead of rolling out
+    #it saves simulator calls, but changes what the advantages are trained on, and the value head is untrained early on
+    valueLeafRate = 0
     #odds of the off player making a random move
     offExploreRate = 0
+    #traverse every off player action instead of sampling one, like vanilla cfr
+    offPlayerFullWidth = False
     #odds of the on player making a random move
     #only used if branchingLimit is not none
     onExploreRate = 0.2
@@ -169,9 +339,38 @@ elif gameName == 'pokemon':
     progressGamesToRecord = 6
     progressGamePath = 'progress/'
 
+    #inference
+    #max number of requests the net process puts in one forward pass
+    maxBatchSize = 64
+    #max time the net process waits to fill a batch after the first request comes in
+    #long enough for a few gloo requests to come in, see warPoker
+    maxWaitMicros = 2000
+    #how search processes send requests to the net process, 'gloo' or 'shm', see warPoker
+    inferenceTransport = 'gloo'
+    #prefix for the shared memory ring files, one pair per search process
+    shmPath = '/dev/shm/shallowred'
+    #number of requests each search process can have in its ring at once
+    shmSlots = 8
+    #longest infoset that fits in a ring slot, longer infosets go through gloo
+    shmMaxInfosetLength = 4096
+    #max number of lstm states the net process caches per network, keyed by infoset prefix, 0 to disable
+    prefixCacheSize = 8192
+    #number of tokens between cached prefixes
+    prefixCacheChunk = 32
+    #also run every cached batch the normal way and complain if the outputs differ
+    verifyPrefixCache = False
+    #file the net process writes its metrics to as json, None to disable
+    telemetryPath = 'telemetry.json'
+    #seconds between telemetry writes
+    telemetryInterval = 10
+    #prefix for chrome trace files of where each process spends its time, None to disable
+    tracePath = None
+
     #training
     #number of epochs for training the advantage network
     advEpochs = 200
+    #train the advantage network in the background while the search processes start the next iteration, see warPoker
+    pipelineTraining = False
     #number of epochs for training the strategy network
     stratEpochs = 5
     #maximum number of samples in an epoch
@@ -209,6 +408,10 @@ elif gameName == 'pokemon':
     #enable an attention later after the lstm
     enableAttention = False
 
+    #evaluate the old networks in getProbs with their lstm weights stacked, see warPoker
+    #this was slower than separate networks at pokemon sizes
+    groupedEnsemble = False
+
     #learn rate for training
     learnRate = 0.001
     #which optimizer to use (adam or sgd)
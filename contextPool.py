@@ -0,0 +1,138 @@
+import asyncio
+import collections
+import numpy as np
+import time
+
+import config
+
+#pool of extra game contexts
+#cfrRecur uses these to expand sibling subtrees at the same time
+#and each concurrent traversal checks one out for its whole game
+#games like pokemon need a context (a PS process) per running game, so each game needs its own
+#games that can fork() don't need a pool at all
+#the contexts are opened once, so process startup is only paid at the start of the search
+
+class ContextPool:
+    def __init__(self, size, getContext=None):
+        self.size = size
+        self.getContext = getContext if getContext else config.game.getContext
+        #context managers, so we can close everything we opened
+        self.managers = []
+        self.contexts = []
+        #contexts that aren't being used
+        #some contexts are None (e.g. warPoker's), so we keep indices instead of the contexts themselves
+        self.free = []
+        #futures for checkouts waiting on a context, oldest first
+        self.waiters = collections.deque()
+        #index => when it was checked out, for contexts in use
+        self.since = {}
+        self.resetStats()
+
+    async def __aenter__(self):
+        for i in range(self.size):
+            manager = self.getContext()
+            self.contexts.append(await manager.__aenter__())
+            self.managers.append(manager)
+            self.free.append(i)
+        return self
+
+    async def __aexit__(self, *args):
+        for manager in self.managers:
+            await manager.__aexit__(*args)
+
+    #adds a context that's already open, like the search process's main context
+    #so it isn't sitting idle while traversals use the pool
+    #the caller still has to close it
+    def add(self, context):
+        self.contexts.append(context)
+        self.free.append(self.size)
+        self.size += 1
+
+    #there's no blocking acquire
+    #whoever would be waiting might be holding the contexts we'd be waiting for
+    #so callers should do the work on the context they already have instead
+    def hasFree(self):
+        return len(self.free) > 0
+
+    def acquire(self):
+        i = self.free.pop()
+        self.since[i] = time.time()
+        return self.contexts[i]
+
+    #waits for a free context
+    #only for callers that don't hold any other contexts, like a traversal that's about to start
+    async def checkout(self):
+        if self.free:
+            i = self.free.pop()
+            self.waits.append(0)
+        else:
+            start = time.time()
+            future = asyncio.get_event_loop().create_future()
+            self.waiters.append(future)
+            self.maxQueueLength = max(self.maxQueueLength, len(self.waiters))
+            i = await future
+            self.waits.append(time.time() - start)
+        self.since[i] = time.time()
+        return self.contexts[i]
+
+    def checkin(self, context):
+        self.release(context)
+
+    def release(self, context):
+        for i, c in enumerate(self.contexts):
+            if c is context and i in self.since:
+                self.busyTime += time.time() - self.since.pop(i)
+                #hand it straight to the oldest waiter, so nothing can cut in line
+                while self.waiters:
+                    future = self.waiters.popleft()
+                    if not future.cancelled():
+                        future.set_result(i)
+                        return
+                self.free.append(i)
+                return
+
+    def resetStats(self):
+        self.statsStart = time.time()
+        #context seconds in use, not counting contexts that are still out
+        self.busyTime = 0
+        for i in self.since:
+            self.since[i] = self.statsStart
+        #seconds each checkout waited for a context
+        self.waits = []
+        self.maxQueueLength = 0
+
+    #returns (utilization, number of checkouts, number that had to wait, mean wait, p95 wait, max queue length)
+    #utilization is the fraction of context time in use since the stats were reset
+    def getStats(self):
+        now = time.time()
+        busyTime = self.busyTime + sum(now - since for since in self.since.values())
+        utilization = busyTime / (self.size * (now - self.statsStart)) if self.size and now > self.statsStart else 0
+        if not self.waits:
+            return (utilization, 0, 0, 0, 0, self.maxQueueLength)
+        waits = np.array(self.waits)
+        return (utilization, len(waits), int(np.sum(waits > 0)), waits.mean(), np.percentile(waits, 95), self.maxQueueLength)
+
+if __name__ == '__main__':
+    #runs more games than there are contexts, to show the queueing and utilization numbers
+    class _Context:
+        async def __aenter__(self):
+            return object()
+        async def __aexit__(self, *args):
+            pass
+
+    async def main(size=4, numRunners=8, numGames=200):
+        async with ContextPool(size, getContext=_Context) as pool:
+            async def runner():
+                for i in range(numGames // numRunners):
+                    context = await pool.checkout()
+                    try:
+                        #stand in for a battle
+                        await asyncio.sleep(0.001)
+                    finally:
+                        pool.checkin(context)
+            await asyncio.gather(*[runner() for i in range(numRunners)])
+            utilization, count, queued, meanWait, p95Wait, maxQueue = pool.getStats()
+            print('contexts', size, 'runners', numRunners, 'utilization', round(utilization, 3), 'checkouts', count, 'queued', queued,
+                    'wait ms mean', round(meanWait * 1000, 3), 'p95', round(p95Wait * 1000, 3), 'max queue length', maxQueue)
+
+    asyncio.get_event_loop().run_until_complete(main())
@@ -8,6 +8,7 @@ import math
 import numpy as np
 import random
 import sys
+import time
 import torch
 import torch.distributed as dist
 import os.path
@@ -15,6 +16,9 @@ import os.path
 import config
 import model
 import dataStorage
+import inference
+import sampling
+import telemetry
 
 #Deep MCCFR
 
@@ -25,6 +29,72 @@ import dataStorage
 #so it needs a separate runner function
 #(not that the other agents even exist any more)
 
+#running log reach probabilities of one player's trajectory under each of the player's old networks
+#getProbs folds in new trajectory steps as they show up, so a game only evaluates each step once per network
+#use one per player per game
+class ReachTracker:
+    def __init__(self):
+        self.logReach = np.zeros(0)
+        #number of trajectory steps that have been folded in
+        self.numSteps = 0
+
+    #starts over if the number of networks changed
+    def sync(self, numModels):
+        if len(self.logReach) != numModels:
+            self.logReach = np.zeros(numModels)
+            self.numSteps = 0
+
+    #outputs has each network's advantages for each of the steps
+    def add(self, agent, outputs, steps):
+        for i in range(len(self.logReach)):
+            for advs, (infoset, actionIndex, actions) in zip(outputs[i], steps):
+                with np.errstate(divide='ignore'):
+                    self.logReach[i] += np.log(agent.getStepProb(advs, actionIndex, len(actions)))
+        self.numSteps += len(steps)
+
+    def getReachProb(self, i):
+        #same floor as DeepCfrAgent.getReachProb
+        return max(math.exp(self.logReach[i]), 0.01)
+
+#subtree values and advantage samples for on player states, kept for one search iteration
+#a hit reuses the subtree as if its off player actions were fixed for the iteration
+#so the samples are added again, which keeps the training data the same as traversing the subtree again
+class TranspositionTable:
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        #key => (value, list of (infoset, advantages, weight, expected value) samples from the subtree)
+        #the samples are None if they can't be replayed, see DeepCfrAgent.replayTranspositions
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    #both players' infosets and whose turn it is
+    #only works for games where that determines the rest of the game, i.e. games with infosetsDetermineState set
+    def getKey(self, game, player):
+        return (player, tuple(game.getInfoset(0)), tuple(game.getInfoset(1)))
+
+    #returns None on a miss
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        #once it's full, only the states we already have get reused
+        if len(self.entries) < self.maxSize:
+            self.entries[key] = entry
+
+    #call at the start of each iteration, as the networks have changed
+    def clear(self):
+        self.entries = {}
+
+    def resetStats(self):
+        self.hits = 0
+        self.misses = 0
+
 class DeepCfrAgent:
     #each player gets one of each model
     #advModels calculates advantages
@@ -69,10 +139,10 @@ class DeepCfrAgent:
             self.advModels = [full.model.DeepCfrModel(name='adv' + str(i), softmax=False, writeLock=writeLock, sharedDict=sharedDict) for i in range(2)]
             self.manageSharedModels = True
 
-        #if stratModels:
-            #self.stratModels = stratModels
-        #else:
-            #self.stratModels = [full.model.DeepCfrModel(name='strat' + str(i), softmax=True, writeLock=writeLock, sharedDict=sharedDict) for i in range(2)]
+        #strategy networks distilled from the old models, see runner.distill
+        self.stratModels = stratModels if stratModels else []
+        #whether getProbs plays with the strategy networks instead of weighting every old model
+        self.playStratModels = False
 
         #TODO REFACTOR everything is single deep
         #whether to save old models for single deep cfr
@@ -80,6 +150,8 @@ class DeepCfrAgent:
         if(singleDeep):
             self.oldModels = [[],[]]
             self.oldModelWeights = [[],[]]
+        #old networks stacked together for getProbs
+        self.ensembles = [None, None]
 
         #TODO REFACTOR we should always train
         #flag so if we never search, we don't bother training
@@ -87,11 +159,67 @@ class DeepCfrAgent:
 
         self.verbose = verbose
 
-    async def search(self, context, distGroup, pid=0, limit=100, innerLoops=1, seed=None, history=[[],[]]):
+        #sends network evaluation requests to the net process
+        self.inferenceClient = inference.getClient()
+        #network outputs we've already gotten this iteration
+        #with pipelined training, networks get swapped in the middle of an iteration
+        #so we can't tell when cached outputs go stale
+        self.predictCache = inference.PredictCache(0 if config.pipelineTraining else config.predictCacheSize)
+
+        #time spent in each part of the search
+        #this only keeps totals until search knows our rank
+        self.tracer = telemetry.Tracer()
+
+        #extra contexts for expanding sibling subtrees concurrently, see contextPool.py
+        self.contextPool = None
+        #number of subtrees expanded concurrently, and ones that had to wait because there was no game for them
+        self.concurrentExpansions = 0
+        self.sequentialExpansions = 0
+        #siblings that needed another game to be expanded concurrently
+        self.forkAttempts = 0
+
+        #number of getTurn/takeAction calls to the game, including the ones startGame makes to replay history
+        #this is most of the cost of a traversal for pokemon
+        self.simulatorCalls = 0
+        #how nodes past the depth limit were evaluated
+        self.valueLeaves = 0
+        self.rolloutLeaves = 0
+
+        #picks which on player actions to expand, see sampling.py
+        self.samplingPolicy = sampling.getPolicy()
+        #number of on player actions expanded (including probes) and pruned
+        self.nodesExpanded = 0
+        self.actionsPruned = 0
+
+        #the networks have to stay the same for a whole iteration
+        #and the keys have to determine the game state, see TranspositionTable.getKey
+        if config.transpositionTableSize and not config.pipelineTraining and getattr(config.game, 'infosetsDetermineState', False):
+            self.transpositions = TranspositionTable(config.transpositionTableSize)
+        else:
+            if config.transpositionTableSize and not config.pipelineTraining:
+                print('not using the transposition table,', config.gameName, "infosets don't determine the game state", file=sys.stderr)
+            self.transpositions = None
+        #a cached subtree is only the same as traversing it again if nothing below it is random
+        #i.e. on player actions are picked deterministically, off player actions are all traversed, and there's no depth limit
+        #then a hit adds the subtree's samples again, otherwise it only reuses the value
+        self.replayTranspositions = self.samplingPolicy.deterministic and config.offPlayerFullWidth and not config.depthLimit
+
+    #innerLoops is the number of traversals per search process
+    #with a scheduler, the processes share innerLoops * number of processes traversals, and faster processes take more
+    async def search(self, context, distGroup, pid=0, limit=100, innerLoops=1, seed=None, history=[[],[]], contextPool=None, scheduler=None):
         self.pid = pid
+        self.contextPool = contextPool
+        self.tracer = telemetry.Tracer(dist.get_rank(), 'search ' + str(pid))
 
         start = config.resumeIter if config.resumeIter else 0
 
+        #concurrent traversals can't share a context if it only runs one game at a time (e.g. a PS process)
+        #so each traversal checks one out of the pool for its whole game
+        checkoutContexts = config.numConcurrentTraversals > 1 and self.contextPool is not None and self.contextPool.size > 0
+        if checkoutContexts:
+            #nothing else uses the main context then, so it goes in the pool with the others
+            self.contextPool.add(context)
+
         if self.pid == 0:
             print(end='', file=sys.stderr)
         for i in range(start, limit):
@@ -104,37 +232,110 @@ class DeepCfrAgent:
 
             #for small games, this is necessary to get a decent number of samples
             print(self.pid, 'starting search')
-            for j in range(innerLoops):
-                if self.pid == 0:
-                    print('\rTurn Progress: ' + str(i) + '/' + str(limit) + ' inner ' + str(j) + '/' + str(innerLoops), end='', file=sys.stderr)
+            if self.transpositions:
+                self.transpositions.clear()
+            searchStart = time.time()
+            #each traversal runner pulls from the same set of traversal numbers
+            #so we do innerLoops traversals no matter how many runners there are
+            if scheduler:
+                quota = innerLoops * dist.get_world_size(distGroup)
+                traversals = scheduler.traversals(i, quota)
+                #a fast process could use up the quota before we get any traversals
+                #but the first search process still has to ask for training
                 self.needsTraining = True
-                #we want each game tree traversal to use the same seed
-                if seed:
-                    curSeed = seed
-                else:
-                    curSeed = config.game.getSeed()
-                game = config.game.Game(context=context, seed=curSeed, history=history, verbose=self.verbose)
-                await game.startGame()
-                await self.cfrRecur(context, game, curSeed, history, i)
-            print(self.pid, 'done with search')
+            else:
+                quota = innerLoops
+                traversals = iter(range(innerLoops))
+            numTraversals = 0
+            if checkoutContexts:
+                self.contextPool.resetStats()
+            async def runTraversals(track):
+                nonlocal numTraversals
+                #each runner gets its own row in the trace
+                telemetry.traceTrack.set(track)
+                for j in traversals:
+                    if self.pid == 0:
+                        print('\rTurn Progress: ' + str(i) + '/' + str(limit) + ' inner ' + str(j) + '/' + str(quota), end='', file=sys.stderr)
+                    self.needsTraining = True
+                    numTraversals += 1
+                    if checkoutContexts:
+                        traversalContext = await self.contextPool.checkout()
+                        try:
+                            await self.traverse(traversalContext, i, seed, history)
+                        finally:
+                            self.contextPool.checkin(traversalContext)
+                    else:
+                        await self.traverse(context, i, seed, history)
+
+            if config.numConcurrentTraversals > 1:
+                #every traversal waiting on the net process lets another traversal run
+                #so the net process gets more requests to batch together
+                await asyncio.gather(*[runTraversals(k) for k in range(config.numConcurrentTraversals)])
+            else:
+                await runTraversals(0)
+            print(self.pid, 'done with search', 'traversals', numTraversals, 'traversals per second', numTraversals / (time.time() - searchStart))
+            count, mean, p50, p95, maxLatency = self.inferenceClient.getLatencyStats()
+            print(self.pid, 'inference requests', count, 'latency ms mean', round(mean * 1000, 3),
+                    'p50', round(p50 * 1000, 3), 'p95', round(p95 * 1000, 3), 'max', round(maxLatency * 1000, 3))
+            self.inferenceClient.resetLatencyStats()
+            print(self.pid, 'predict cache hits', self.predictCache.hits, 'misses', self.predictCache.misses)
+            self.predictCache.resetStats()
+            if checkoutContexts:
+                utilization, count, queued, meanWait, p95Wait, maxQueue = self.contextPool.getStats()
+                print(self.pid, 'context pool size', self.contextPool.size, 'utilization', round(utilization, 3), 'checkouts', count, 'queued', queued,
+                        'wait ms mean', round(meanWait * 1000, 3), 'p95', round(p95Wait * 1000, 3), 'max queue length', maxQueue)
+            if self.forkAttempts:
+                #how often a sibling had to wait for the others because there wasn't a free context
+                print(self.pid, 'subtrees expanded concurrently', self.concurrentExpansions, 'without a free context', self.sequentialExpansions,
+                        'fallback rate', round(self.sequentialExpansions / self.forkAttempts, 3))
+            self.concurrentExpansions = 0
+            self.sequentialExpansions = 0
+            self.forkAttempts = 0
+            print(self.pid, 'simulator calls per traversal', self.simulatorCalls / max(numTraversals, 1),
+                    'depth limit leaves from value net', self.valueLeaves, 'from rollout', self.rolloutLeaves)
+            self.simulatorCalls = 0
+            self.valueLeaves = 0
+            self.rolloutLeaves = 0
+            print(self.pid, self.samplingPolicy.name, 'sampling', 'nodes expanded per traversal', self.nodesExpanded / max(numTraversals, 1),
+                    'actions pruned per traversal', self.actionsPruned / max(numTraversals, 1))
+            self.nodesExpanded = 0
+            self.actionsPruned = 0
+            if self.transpositions:
+                lookups = self.transpositions.hits + self.transpositions.misses
+                print(self.pid, 'transposition table hits', self.transpositions.hits, 'misses', self.transpositions.misses,
+                        'hit rate', self.transpositions.hits / max(lookups, 1), 'states', len(self.transpositions.entries),
+                        'replaying samples' if self.replayTranspositions else 'values only')
+                self.transpositions.resetStats()
 
 
             #save our adv data after each iteration
             #so the non-zero pid workers don't have data cached
-            self.advModels[i % 2].clearSampleCache()
+            with self.tracer.span('clearSampleCache'):
+                self.advModels[i % 2].clearSampleCache()
             #go ahead and clear our strat caches as well
             #just in case the program is exited
             #for j in range(2):
                 #self.stratModels[j].clearSampleCache()
 
-            dist.barrier(distGroup)
+            #time at the barriers is how long we waited on slower search processes (and training)
+            barrierStart = time.time()
+            with self.tracer.span('barrier'):
+                dist.barrier(distGroup)
+            print(self.pid, 'idle at barrier seconds', round(time.time() - barrierStart, 3))
 
             if self.pid == 0:
                 if self.needsTraining:
                     print('sending train message')
-                    self.advTrain(i % 2, iter=i // 2 + 1)
+                    with self.tracer.span('train'):
+                        self.advTrain(i % 2, iter=i // 2 + 1)
 
-            distGroup.barrier()
+            with self.tracer.span('barrier'):
+                distGroup.barrier()
+            self.tracer.dumpTotals()
+            self.tracer.flush()
+
+            #this iteration's player has a new network, so the old outputs are stale
+            self.predictCache.invalidate(i % 2)
 
             if os.path.isfile('stopEarly'):
                 #cant' rename the file here
@@ -158,6 +359,19 @@ class DeepCfrAgent:
             print('playtime is over', file=sys.stderr)
             print(file=sys.stderr)
 
+    #runs a single game tree traversal from the start of the game
+    async def traverse(self, context, iter, seed, history):
+        #we want each game tree traversal to use the same seed
+        if seed:
+            curSeed = seed
+        else:
+            curSeed = config.game.getSeed()
+        with self.tracer.span('startGame'):
+            game = config.game.Game(context=context, seed=curSeed, history=history, verbose=self.verbose)
+            await game.startGame()
+        self.simulatorCalls += self.replayCalls(history)
+        await self.cfrRecur(context, game, curSeed, history, iter)
+
     def advTrain(self, player, iter=1):
         #send message to net process to train network
         dist.send(torch.tensor([1, player, 0]), dst=0)
@@ -176,78 +390,94 @@ class DeepCfrAgent:
             #self.sharedDict['oldModelWeights'] = self.oldModelWeights
 
 
-    #TODO REFACTOR we don't train a strategy network anymore
+    #trains the strategy networks on the samples from runner.distill
+    #each network is saved under the newest iteration of the old models it was distilled from
     def stratTrain(self):
-        if(self.singleDeep):
-            self.oldModels = self.sharedDict['oldModels']
-            self.oldModelWeights = self.sharedDict['oldModelWeights']
-            print('skipping strategy', file=sys.stderr)
-            return
-        if self.pid == 0:
-            print('training strategy', file=sys.stderr)
-        #we train both strat models at once
+        print('training strategy', file=sys.stderr)
         for i, model in enumerate(self.stratModels):
-            #let's try copying the embedding from the current adv net
-            model.net.embeddings = self.advModels[i].net.embeddings
-            model.train(epochs=config.stratEpochs)
-
-    def getPredict(self, player, infoset):
-        inputTensor = model.infosetToTensor(infoset)
-        #if self.pid == 1:
-            #print('sending', inputTensor)
-        #print(self.pid, 'sending request')
-        #print(self.pid, 'sending', inputTensor)
-        dist.send(torch.tensor([2, player, inputTensor.shape[0]]), dst=0)
-        #print(self.pid, 'sending input with shape', inputTensor.shape, 'dtype', inputTensor.dtype, inputTensor)
-        dist.send(inputTensor, dst=0)
-        out = torch.zeros(config.game.numActions + 1)
-        #print(self.pid, 'getting output')
-        dist.recv(out, src=0)
-        #print(self.pid, 'got output')
-        out = out.detach().numpy()
-        #if self.pid == 1:
-            #print('got', out)
-        return out[0:-1], out[-1]
+            model.train(max(self.oldModelWeights[i]), epochs=config.stratEpochs)
+
+    async def getPredict(self, player, infoset):
+        #hashing the infoset isn't free, so skip the cache entirely when it's off
+        if not self.predictCache.maxSize:
+            with self.tracer.span('inference'):
+                return await self.inferenceClient.predict(player, infoset)
+        key = self.predictCache.getKey(infoset)
+        out = self.predictCache.get(player, key)
+        if out is None:
+            #the client doesn't block, so other traversals can run while we wait on the net process
+            with self.tracer.span('inference'):
+                out = await self.inferenceClient.predict(player, infoset)
+            self.predictCache.put(player, key, out)
+        return out
 
     #getting probability for a given model to follow a given trajectory
     #where a trajectory is a list of infoset-action pairs
     def getReachProb(self, model, traj):
+        return self.getReachProbFromOutputs([model.predict(infoset)[0] for infoset, actionIndex, actions in traj], traj)
+
+    #same as getReachProb, but with the model's advantages for each infoset in the trajectory already calculated
+    def getReachProbFromOutputs(self, outputs, traj):
         reachProb = 1
-        for infoset, actionIndex, actions in traj:
-            numActions = len(actions)
-            probs, _ = model.predict(infoset)
-            probs = probs[0:numActions]
-            #actionNum = config.game.enumAction(action)
-            for i, p in enumerate(probs):
-                if probs[i] < 0:
-                    probs[i] = 0
-            pSum = sum(probs)
-            if pSum > 0:
-                reachProb *= probs[actionIndex] / pSum
-            else:
-                #if pSum is 0, assume we played randomly
-                reachProb *= 1 / numActions
+        for advs, (infoset, actionIndex, actions) in zip(outputs, traj):
+            reachProb *= self.getStepProb(advs, actionIndex, len(actions))
         #if we have an action that never accumulates any regret, then the models might all spit out 0
         #which would give a reach probability of 0
         return max(reachProb, 0.01)
 
+    #probability of a model taking the action, given its advantages
+    def getStepProb(self, advs, actionIndex, numActions):
+        probs = np.array(advs[0:numActions])
+        #actionNum = config.game.enumAction(action)
+        for i, p in enumerate(probs):
+            if probs[i] < 0:
+                probs[i] = 0
+        pSum = sum(probs)
+        if pSum > 0:
+            return probs[actionIndex] / pSum
+        else:
+            #if pSum is 0, assume we played randomly
+            return 1 / numActions
+
+    #model.NetEnsemble of the player's old networks, rebuilt whenever the networks change
+    def getEnsemble(self, player):
+        nets = self.oldModels[player]
+        ensemble = self.ensembles[player]
+        if ensemble is None or len(ensemble.nets) != len(nets) or any(a is not b for a, b in zip(ensemble.nets, nets)):
+            ensemble = model.NetEnsemble(list(nets))
+            self.ensembles[player] = ensemble
+        return ensemble
+
     #getting final probabilities for executing a strategy
-    def getProbs(self, player, infoset, actions, prevTrajectory=None, file=sys.stdout):
+    #reachTracker is a ReachTracker for this player's trajectory in this game
+    #passing one in means each trajectory step only gets evaluated once, instead of every turn
+    def getProbs(self, player, infoset, actions, prevTrajectory=None, file=sys.stdout, reachTracker=None):
+        probs, expVal = self.getStrategy(player, infoset, actions, prevTrajectory, file=file, reachTracker=reachTracker)
+        return probs
+
+    #same as getProbs, but also returns the expected value
+    def getStrategy(self, player, infoset, actions, prevTrajectory=None, file=sys.stdout, reachTracker=None):
         print('infoset', infoset, file=file)
         #TODO REFACTOR we're always using single deep
-        if(self.singleDeep):
+        if self.singleDeep and not self.playStratModels:
             stratProbs = None
             expVal = 0
             weights = []
-            model = self.advModels[player]
             totalWeight = 0
+            prevTrajectory = prevTrajectory if prevTrajectory else []
+            if reachTracker is None:
+                reachTracker = ReachTracker()
+            reachTracker.sync(len(self.oldModels[player]))
+            newSteps = prevTrajectory[reachTracker.numSteps:]
+            #every old network's output for every new step in the trajectory and the current infoset, all at once
+            outs = self.getEnsemble(player).predict([step[0] for step in newSteps] + [infoset])
+            reachTracker.add(self, outs[:, :-1, :-1], newSteps)
             for i in range(len(self.oldModels[player])):
-                model.net = self.oldModels[player][i]
                 weight = self.oldModelWeights[player][i]
-                reachProb = self.getReachProb(model, prevTrajectory)
+                reachProb = reachTracker.getReachProb(i)
                 weight *= reachProb
                 totalWeight += weight
-                probs, ev = model.predict(infoset, trace=False)
+                probs, ev = outs[i, -1, :-1].copy(), outs[i, -1, -1]
                 print('raw probs', probs, file=file)
                 probs = probs[0:len(actions)]
                 _, bestIndex = max([(p, i) for (i, p) in enumerate(probs)])
@@ -286,22 +516,27 @@ class DeepCfrAgent:
 
         pSum = np.sum(probs)
         if pSum > 0:
-            return probs / np.sum(probs)
+            return probs / np.sum(probs), expVal
         else:
             #play randomly
-            return np.array([1 / len(actions) for a in actions])
+            return np.array([1 / len(actions) for a in actions]), expVal
+
+    #number of simulator calls startGame makes for the history
+    def replayCalls(self, history):
+        return 2 * (len(history[0]) + len(history[1]))
 
     #recursive implementation of cfr
     #history is a list of (seed, player, action) tuples
     #assumes the game has already had the history applied
-    async def cfrRecur(self, context, game, startSeed, history, iter, depth=0, q=1, rollout=False):
-        if config.depthLimit and depth > config.depthLimit:
-            rollout = True
-
+    #samples is a list that gets every advantage sample added in this subtree, for the transposition table
+    #offReach is the off player's odds of playing to here, which is only less than 1 with offPlayerFullWidth
+    async def cfrRecur(self, context, game, startSeed, history, iter, depth=0, q=1, rollout=False, samples=None, offReach=1):
         onPlayer = iter % 2
         offPlayer = (iter + 1) % 2
 
-        player, req, actions = await game.getTurn()
+        with self.tracer.span('step'):
+            player, req, actions = await game.getTurn()
+        self.simulatorCalls += 1
 
         if 'win' in req:
             if player == onPlayer:
@@ -313,22 +548,54 @@ class DeepCfrAgent:
         #game uses append, so we have to make a copy to keep everything consistent when we get advantages later
         infoset = copy.copy(game.getInfoset(player))
 
+        if config.depthLimit and depth > config.depthLimit:
+            #this is the first node past the limit, unless we're already rolling out
+            #the value net is trained on stateExpValue, so it can stand in for the rest of the game
+            #but only once both players' networks have been trained
+            if not rollout and iter >= 2 and random.random() < config.valueLeafRate:
+                self.valueLeaves += 1
+                _, value = await self.getPredict(player, infoset)
+                #values are from the perspective of the player whose network it is
+                return value if player == onPlayer else -1 * value
+            if not rollout:
+                self.rolloutLeaves += 1
+            rollout = True
+
         if player == offPlayer:
             #get probs so we can sample a single action
-            probs, _ = self.regretMatch(offPlayer, infoset, actions, -1)
+            probs, _ = await self.regretMatch(offPlayer, infoset, actions, -1)
             exploreProbs = probs * (1 - config.offExploreRate) + config.offExploreRate / len(actions)
-            actionIndex = np.random.choice(len(actions), p=exploreProbs)
 
             #if depth == 1 and self.pid == 0:
                 #print('offplayer ' + str(player) + ' hand ' + str(game.hands[player]) + ' probs', list(zip(actions, probs)), file=sys.stderr)
-            await game.takeAction(player, actionIndex)
+            async def step(game, actionIndex, childOffReach):
+                with self.tracer.span('step'):
+                    await game.takeAction(player, actionIndex)
+                self.simulatorCalls += 1
 
-            if player == 0:
-                newHistory = [history[0] + [(None, actionIndex)], history[1]]
+                if player == 0:
+                    newHistory = [history[0] + [(None, actionIndex)], history[1]]
+                else:
+                    newHistory = [history[0], history[1] + [(None, actionIndex)]]
+
+                return await self.cfrRecur(context, game, startSeed, newHistory, iter, depth=depth, rollout=rollout, q=q, samples=samples, offReach=childOffReach)
+
+            if config.offPlayerFullWidth and not rollout:
+                #every action the off player might take, weighted by its odds
+                #which is the expected value of sampling one
+                snap = game.snapshot() if hasattr(game, 'snapshot') else None
+                onExpValue = 0
+                gameUsed = False
+                for actionIndex in range(len(actions)):
+                    if exploreProbs[actionIndex] == 0:
+                        continue
+                    if gameUsed:
+                        game = await self.rewindGame(game, snap, context, startSeed, history)
+                    gameUsed = True
+                    onExpValue += exploreProbs[actionIndex] * await step(game, actionIndex, offReach * exploreProbs[actionIndex])
             else:
-                newHistory = [history[0], history[1] + [(None, actionIndex)]]
-
-            onExpValue = await self.cfrRecur(context, game, startSeed, newHistory, iter, depth=depth, rollout=rollout, q=q)
+                actionIndex = np.random.choice(len(actions), p=exploreProbs)
+                onExpValue = await step(game, actionIndex, offReach)
 
             #save sample for final average strategy
             """
@@ -339,8 +606,26 @@ class DeepCfrAgent:
             return onExpValue
 
         elif player == onPlayer:
+            #we might have already traversed this state in this iteration
+            key = None
+            if self.transpositions is not None and not rollout:
+                key = self.transpositions.getKey(game, player)
+                entry = self.transpositions.get(key)
+                if entry is not None:
+                    value, subtreeSamples = entry
+                    if subtreeSamples is not None:
+                        am = self.advModels[onPlayer]
+                        with self.tracer.span('addSample'):
+                            for sampleInfoset, advantages, weight, sampleValue in subtreeSamples:
+                                am.addSample(sampleInfoset, advantages, weight, sampleValue)
+                        if samples is not None:
+                            samples.extend(subtreeSamples)
+                    return value
+            #samples from this subtree, which go in the table along with the value
+            subtreeSamples = [] if key is not None and self.replayTranspositions else samples
+
             #get probs, which action we take depends on the configuration
-            probs, regrets = self.regretMatch(onPlayer, infoset, actions, depth)
+            probs, regrets = await self.regretMatch(onPlayer, infoset, actions, depth)
             #I don't think I'm using sampleProbs for anything
             if rollout:
                 #we pick one action according to the current strategy
@@ -349,65 +634,101 @@ class DeepCfrAgent:
                 actionIndices = [np.random.choice(len(actions), p=probs)]
                 #sampleProbs don't matter, but this is accurate
                 sampleProbs = probs
-            elif config.branchingLimit:
-                #select a set of actions to pick
-                #chance to play randomly instead of picking the best actions
-                #this paper suggests playing according the currect strategy with some exploration factor for outcome
-                #sampling (i.e. branchLimit = 1), so I assume that that's a good method for other branch limits
-                #http://mlanctot.info/files/papers/nips09mccfr.pdf
-                #the double neural CFR paper suggests using uniform random distribution, which is probably fine too
-                exploreProbs = probs * (1 - config.onExploreRate) + config.onExploreRate / len(probs)
-                actionIndices = np.random.choice(len(actions), min(len(actions), config.branchingLimit), 
-                        replace=False, p=exploreProbs)
-                #this is only true for branchingLimit=1, but I don't feel like coding a general solution right now
-                sampleProbs = exploreProbs
+                pruned = []
             else:
-                #we're picking every action
-                actionIndices = list(range(len(actions)))
-                #100% chance of sampling each action
-                sampleProbs = np.ones(probs.shape)
+                actionIndices, sampleProbs, pruned = self.samplingPolicy.select(probs, regrets, len(actions))
+                self.actionsPruned += len(pruned)
 
             #get expected reward for each action
-            rewards = []
-            gameUsed = False
-
+            #None for actions that don't get a reward at all
+            rewards = [None for a in actions]
+            #(action index, whether to roll out) for each action we expand
+            children = []
             for i in range(len(actions)):
-                action = actions[i]
-
+                if i in pruned:
+                    #regret matching gives pruned actions 0 probability, so this doesn't change the state's value
+                    #their advantage gets filled in below
+                    rewards[i] = 0
+                    continue
                 #use rollout for non-sampled actions
-                if not i in actionIndices and not rollout:
+                elif not i in actionIndices and not rollout:
                     if not config.enableProbingRollout:
-                        rewards.append(0)
+                        rewards[i] = 0
                         continue
                     #rollout non-sampled actions
-                    curRollout = True
+                    children.append((i, True))
                 elif not i in actionIndices:
                     #if we're rolling out, just pretend the other actions don't exist
                     continue
                 else:
-                    curRollout = rollout
+                    children.append((i, rollout))
+
+            #games that can snapshot their state can rewind for each branch
+            #instead of replaying the whole history
+            snap = game.snapshot() if hasattr(game, 'snapshot') else None
+
+            #takes the action on the given game and gets the reward for the subtree
+            #pooled is whether childContext came from the context pool and needs to be released
+            async def expand(childGame, childContext, pooled, i, curRollout):
+                self.nodesExpanded += 1
+                try:
+                    if childGame is None:
+                        #a context from the pool, which doesn't have the game on it yet
+                        childGame = await self.rewindGame(None, None, childContext, startSeed, history)
+                    #I want to see if we get good results by keeping the RNG the same
+                    #this is closer to normal external sampling
+                    #seed = await game.resetSeed()
+                    with self.tracer.span('step'):
+                        await childGame.takeAction(player, i)
+                    self.simulatorCalls += 1
+                    #historyEntry = (None, player, action)
+
+                    if player == 0:
+                        newHistory = [history[0] + [(None, i)], history[1]]
+                    else:
+                        newHistory = [history[0], history[1] + [(None, i)]]
+
+                    rewards[i] = await self.cfrRecur(childContext, childGame, startSeed, newHistory, iter, depth=depth+1, rollout=curRollout, q=q*sampleProbs[i], samples=subtreeSamples, offReach=offReach)
+                finally:
+                    if pooled:
+                        self.contextPool.release(childContext)
+
+            if config.concurrentExpansion and len(children) > 1:
+                #siblings run at the same time, each on its own game
+                #so their network requests get to the net process together and can be batched
+                #siblings that can't get a game are expanded one at a time afterwards
+                forks = [self.forkGame(game, context) for child in children[1:]]
+                concurrent = [(game, context, False) + children[0]]
+                concurrent += [fork + child for fork, child in zip(forks, children[1:]) if fork is not None]
+                sequential = [child for fork, child in zip(forks, children[1:]) if fork is None]
+                self.concurrentExpansions += len(concurrent)
+                self.sequentialExpansions += len(sequential)
+                self.forkAttempts += len(forks)
+                results = await asyncio.gather(*[expand(*c) for c in concurrent], return_exceptions=True)
+                #only raise once every sibling is done, so all their pooled contexts are back
+                for result in results:
+                    if isinstance(result, BaseException):
+                        raise result
+                gameUsed = True
+            else:
+                sequential = children
+                gameUsed = False
 
+            for i, curRollout in sequential:
                 #don't have to re-init game for the first action
                 if gameUsed:
-                    game = config.game.Game(context, seed=startSeed, history=history, verbose=self.verbose)
-                    await game.startGame()
-                    await game.getTurn()
+                    game = await self.rewindGame(game, snap, context, startSeed, history)
                 else:
                     gameUsed = True
+                await expand(game, context, False, i, curRollout)
 
-                #I want to see if we get good results by keeping the RNG the same
-                #this is closer to normal external sampling
-                #seed = await game.resetSeed()
-                await game.takeAction(player, i)
-                #historyEntry = (None, player, action)
+            if not rollout and self.samplingPolicy.weighted and not config.enableProbingRollout:
+                #non-sampled actions get 0, so dividing by the sample odds makes each action's value unbiased
+                #probed actions have values of their own, which is why this is only without probing
+                for i in actionIndices:
+                    rewards[i] = rewards[i] / sampleProbs[i]
 
-                if player == 0:
-                    newHistory = [history[0] + [(None, i)], history[1]]
-                else:
-                    newHistory = [history[0], history[1] + [(None, i)]]
-
-                r = await self.cfrRecur(context, game, startSeed, newHistory, iter, depth=depth+1, rollout=curRollout, q=q*sampleProbs[i])
-                rewards.append(r)
+            rewards = [r for r in rewards if r is not None]
 
             if not rollout:
                 #save sample of advantages
@@ -439,6 +760,10 @@ class DeepCfrAgent:
                 for p,r in zip(probs, rewards):
                     stateExpValue += p * r
                 advantages = [r - stateExpValue for r in rewards]
+                #pruned actions keep the advantage the network already predicts for them
+                #the policy re-expands them now and then, which is when they get a real label
+                for i in pruned:
+                    advantages[i] = regrets[i]
                 #if self.pid == 0:
                     #print('infoset', infoset)
                     #print('q', q, 'exp val', stateExpValue)
@@ -450,8 +775,18 @@ class DeepCfrAgent:
                     #print('onplayer', player, 'hand', game.hands[player], 'new advs', list(zip(actions, advantages)), 'exp value', stateExpValue, file=sys.stderr)
                 #print('advantages', advantages)
 
+                #with offPlayerFullWidth, every off player action is traversed instead of the ones they'd pick
+                #so weighting by their odds of getting here trains on the same thing as sampling, on average
+                weight = (iter // 2 + 1) * offReach
                 am = self.advModels[onPlayer]
-                am.addSample(infoset, advantages, iter // 2 + 1, stateExpValue)
+                with self.tracer.span('addSample'):
+                    am.addSample(infoset, advantages, weight, stateExpValue)
+                if subtreeSamples is not None:
+                    subtreeSamples.append((infoset, advantages, weight, stateExpValue))
+                if key is not None:
+                    self.transpositions.put(key, (stateExpValue, subtreeSamples if self.replayTranspositions else None))
+                    if samples is not None:
+                        samples.extend(subtreeSamples)
 
                 #if depth == 0 and self.pid == 0:
                     #print('player', str(onPlayer), file=sys.stderr)
@@ -465,12 +800,37 @@ class DeepCfrAgent:
                 return rewards[0]
 
    
+    #puts game back in the state it was in when snap was taken, for taking another action
+    #games that can't snapshot get replaced by a new game with the history replayed
+    async def rewindGame(self, game, snap, context, startSeed, history):
+        if snap is not None:
+            with self.tracer.span('restore'):
+                game.restore(snap)
+            return game
+        with self.tracer.span('startGame'):
+            game = config.game.Game(context, seed=startSeed, history=history, verbose=self.verbose)
+            await game.startGame()
+            await game.getTurn()
+        self.simulatorCalls += self.replayCalls(history) + 1
+        return game
+
+    #makes another game in the same state as game, for expanding a sibling subtree concurrently
+    #returns (game, context, whether the context is from the pool) or None if there isn't a game we can use
+    #games that can't fork get a context from the pool, and the game is None until expand replays the history on it
+    #so the replays for all the siblings run at the same time
+    def forkGame(self, game, context):
+        if hasattr(game, 'fork'):
+            return (game.fork(), context, False)
+        if self.contextPool is None or not self.contextPool.hasFree():
+            return None
+        return (None, self.contextPool.acquire(), True)
+
     #generates probabilities for each action
     #based on modeled advantages
-    def regretMatch(self, player, infoset, actions, depth):
+    async def regretMatch(self, player, infoset, actions, depth):
         #am = self.advModels[player]
         #advs, expVal = am.predict(infoset)
-        advs, expVal = self.getPredict(player, infoset)
+        advs, expVal = await self.getPredict(player, infoset)
         #illegal actions should be 0
         flatAdvs = np.zeros(len(advs))
         #actionNums = [config.game.enumAction(a) for a in actions]
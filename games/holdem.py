@@ -1,10 +1,36 @@
+import array
 import asyncio
 import copy
+import itertools
+import numpy as np
 import random
 import sys
 
+#heads up limit hold'em
+#same interface as warPoker: the dealer deals, then the usual four betting rounds
+#the dealer is the small blind, acts first preflop and last after that
+#bets and raises are fixed size, and each round is capped at MAX_BETS bets (the big blind counts preflop)
+
 numActions = 4
 
+#nothing in the game waits on anything, so Game's async methods just wrap synchronous versions
+#the benchmark below uses those directly
+
+#the cards that haven't been dealt yet aren't in either infoset, so two games with the same infosets can still differ
+#which means deepcfr's transposition table can't be used
+infosetsDetermineState = False
+
+SMALL_BLIND = 1
+BIG_BLIND = 2
+#bet size for preflop and the flop
+SMALL_BET = 2
+#bet size for the turn and the river
+BIG_BET = 4
+MAX_BETS = 4
+#most a player can lose, which is 4 capped rounds
+#winnings are divided by this to be between -1 and 1
+MAX_WINNINGS = MAX_BETS * (2 * SMALL_BET + 2 * BIG_BET)
+
 #don't need context
 class _Context:
     async def __aenter__(self):
@@ -18,11 +44,491 @@ def getContext():
 def prettyPrintMove(move, req=None):
     return move
 
+#cards are 0 to 51, rank is card >> 2 (0 is a 2, 12 is an ace) and suit is card & 3
+RANK_NAMES = '23456789TJQKA'
+SUIT_NAMES = 'cdhs'
+CARD_NAMES = [r + s for r in RANK_NAMES for s in SUIT_NAMES]
+
+#hand evaluator
+#a 7 card hand is scored by table lookups on sums of per card keys, like SKPokerEval
+#the rank keys are picked so that every 7 card multiset of ranks sums to a different number
+#and the suit keys so that the suit sum tells which suit (if any) has 5 or more cards
+#non-flush hands look up the rank sum, flushes look up a bitmask of the flush suit's ranks
+#scores are dense, higher is better, and the same score means a tie
+
+RANK_KEYS = [0, 1, 5, 22, 98, 453, 2031, 8698, 22854, 83661, 262349, 636345, 1479181]
+SUIT_KEYS = [0, 1, 8, 57]
+#the suit sum is at most 7 * 57, so it fits below the rank sum in one integer
+SUIT_BITS = 9
+SUIT_MASK = (1 << SUIT_BITS) - 1
+
+CATEGORY_NAMES = ['high card', 'pair', 'two pair', 'three of a kind', 'straight', 'flush', 'full house', 'four of a kind', 'straight flush']
+
+#rank of the high card of the best straight in the rank bitmask, or -1
+def _straightHigh(mask):
+    for high in range(12, 3, -1):
+        window = 0x1f << (high - 4)
+        if mask & window == window:
+            return high
+    #ace plays low in the wheel
+    if mask & 0x100f == 0x100f:
+        return 3
+    return -1
+
+#comparable score for the best 5 cards, used to build the tables
+def _score(category, ranks):
+    score = category
+    for i in range(5):
+        score = score * 13 + (ranks[i] if i < len(ranks) else 0)
+    return score
+
+#best score of 7 cards with the given counts of each rank, ignoring flushes
+def _rankScore(counts):
+    byCount = [[r for r in range(12, -1, -1) if counts[r] == n] for n in range(5)]
+    present = [r for r in range(12, -1, -1) if counts[r]]
+    if byCount[4]:
+        quads = byCount[4][0]
+        return _score(7, [quads] + [r for r in present if r != quads][:1])
+    if byCount[3] and len(byCount[3]) + len(byCount[2]) >= 2:
+        trips = byCount[3][0]
+        pair = max([r for r in byCount[3] + byCount[2] if r != trips])
+        return _score(6, [trips, pair])
+    straight = _straightHigh(sum(1 << r for r in present))
+    if straight >= 0:
+        return _score(4, [straight])
+    if byCount[3]:
+        trips = byCount[3][0]
+        return _score(3, [trips] + [r for r in present if r != trips][:2])
+    if len(byCount[2]) >= 2:
+        pairs = byCount[2][:2]
+        return _score(2, pairs + [r for r in present if r not in pairs][:1])
+    if byCount[2]:
+        pair = byCount[2][0]
+        return _score(1, [pair] + [r for r in present if r != pair][:3])
+    return _score(0, present[:5])
+
+#best score of the flush suit's cards, given their rank bitmask
+def _flushScore(mask):
+    straight = _straightHigh(mask)
+    if straight >= 0:
+        return _score(8, [straight])
+    return _score(5, [r for r in range(12, -1, -1) if mask & (1 << r)][:5])
+
+def _buildTables():
+    rankScores = {}
+    for ranks in itertools.combinations_with_replacement(range(13), 7):
+        counts = [0] * 13
+        for r in ranks:
+            counts[r] += 1
+        if max(counts) > 4:
+            continue
+        rankScores[sum(RANK_KEYS[r] for r in ranks)] = _rankScore(counts)
+    flushScores = {}
+    for n in range(5, 8):
+        for ranks in itertools.combinations(range(13), n):
+            mask = sum(1 << r for r in ranks)
+            flushScores[mask] = _flushScore(mask)
+
+    #replace the scores with their order, so they fit in 16 bits
+    scores = sorted(set(rankScores.values()) | set(flushScores.values()))
+    dense = {score: i for i, score in enumerate(scores)}
+    rankTable = array.array('H', bytes(2 * (max(rankScores) + 1)))
+    for key, score in rankScores.items():
+        rankTable[key] = dense[score]
+    flushTable = array.array('H', bytes(2 * (1 << 13)))
+    for mask, score in flushScores.items():
+        flushTable[mask] = dense[score]
+    #first dense score of each category
+    categoryStarts = [min(dense[score] for score in scores if score // 13 ** 5 == category) for category in range(len(CATEGORY_NAMES))]
+
+    #suit of the flush for each suit sum, or -1
+    flushSuits = array.array('b', [-1] * (7 * SUIT_KEYS[-1] + 1))
+    for suits in itertools.combinations_with_replacement(range(4), 7):
+        for suit in range(4):
+            if suits.count(suit) >= 5:
+                flushSuits[sum(SUIT_KEYS[s] for s in suits)] = suit
+    return rankTable, flushTable, flushSuits, categoryStarts
+
+_rankTable, _flushTable, _flushSuits, _categoryStarts = _buildTables()
+
+#rank key and suit key of each card, packed together
+_cardKeys = [(RANK_KEYS[c >> 2] << SUIT_BITS) + SUIT_KEYS[c & 3] for c in range(52)]
+_cardBits = [1 << (c >> 2) for c in range(52)]
+
+#numpy copies for evaluateBatch
+_rankTableNp = np.frombuffer(_rankTable, dtype=np.uint16)
+_flushTableNp = np.frombuffer(_flushTable, dtype=np.uint16)
+_flushSuitsNp = np.frombuffer(_flushSuits, dtype=np.int8)
+_cardKeysNp = np.array(_cardKeys, dtype=np.int64)
+
+#score of 7 cards
+def evaluate(cards):
+    key = 0
+    for c in cards:
+        key += _cardKeys[c]
+    suit = _flushSuits[key & SUIT_MASK]
+    if suit < 0:
+        return _rankTable[key >> SUIT_BITS]
+    mask = 0
+    for c in cards:
+        if c & 3 == suit:
+            mask |= _cardBits[c]
+    return _flushTable[mask]
+
+#scores of a (number of hands, 7) array of cards
+def evaluateBatch(cards):
+    keys = _cardKeysNp[cards].sum(axis=1)
+    scores = _rankTableNp[keys >> SUIT_BITS]
+    suits = _flushSuitsNp[keys & SUIT_MASK]
+    flushes = np.flatnonzero(suits >= 0)
+    if len(flushes):
+        flushCards = cards[flushes]
+        inSuit = (flushCards & 3) == suits[flushes, None]
+        masks = np.sum(np.where(inSuit, 1 << (flushCards >> 2), 0), axis=1)
+        scores[flushes] = _flushTableNp[masks]
+    return scores
+
+#index into CATEGORY_NAMES for a score
+def getCategory(score):
+    category = 0
+    while category + 1 < len(_categoryStarts) and score >= _categoryStarts[category + 1]:
+        category += 1
+    return category
+
+#our state machine for the game
 class _Game:
+    START = 0
+    PREFLOP = 1
+    FLOP = 2
+    TURN = 3
+    RIVER = 4
+    END = 5
 
+    #all possible actions
     DEAL = 'deal'
     FOLD = 'fold'
-    CALL = 'call'
-    RAISE = 'raise'
+    CALL = 'call'#also check
+    RAISE = 'raise'#also bet
+
+    #board cards revealed at the start of each round
+    streetNames = {FLOP: 'flop', TURN: 'turn', RIVER: 'river'}
+    #(first, last) index of the round's board cards in the board
+    streetCards = {FLOP: (0, 3), TURN: (3, 4), RIVER: (4, 5)}
+
+def panic():
+    print("ERROR THIS SHOULD NEVER HAPPEN", file=sys.stderr)
+    quit()
+
+def getSeed():
+    return random.random()
+
+class Game:
+    def __init__(self, context=None, history=[[],[]], seed=None, saveTrajectories=False, verbose=False, file=sys.stdout):
+        self.history = history
+        self.seed = seed
+        if seed:
+            self.random = random.Random(seed)
+        else:
+            self.random = random.Random()
+        self.file = file
+        self.saveTrajectories = saveTrajectories
+
+        self.curActions = []
+        self.curPlayer = None
+
+        #this won't get set properly until the history is applied
+        self.dealer = 0
+
+        #each player's hole cards, then the board
+        self.cards = ()
+        self.street = _Game.START
+        #chips each player has put in
+        self.pot = [0, 0]
+        #bets made this round, including the big blind
+        self.numBets = 0
+        #actions taken this round
+        self.roundActions = 0
+        #player whose turn it is
+        self.toAct = 0
+        #set when someone folds
+        self._winner = None
+        #each player's score, calculated at the first showdown
+        self.scores = None
+
+        #(winner, winnings) once the game is over, winner is -1 for a tie
+        self.result = None
+        #only made if something awaits the winner, traversals don't need it
+        self._winnerFuture = None
+
+        if self.saveTrajectories:
+            #list of (infoset, action)
+            #for each player
+            self.prevTrajectories = [[],[]]
+
+        self.verbose = verbose
+        self.infosets = [['start'],['start']]
+
+    #future for (winner, winnings)
+    @property
+    def winner(self):
+        if self._winnerFuture is None:
+            loop = asyncio.get_event_loop()
+            self._winnerFuture = loop.create_future()
+            if self.result is not None:
+                self._winnerFuture.set_result(self.result)
+        return self._winnerFuture
+
+    def setResult(self, result):
+        self.result = result
+        if self._winnerFuture is not None and not self._winnerFuture.done():
+            self._winnerFuture.set_result(result)
+
+    async def startGame(self):
+        self.startGameSync()
+
+    async def getTurn(self):
+        return self.getTurnSync()
+
+    async def takeAction(self, player, actionIndex):
+        self.takeActionSync(player, actionIndex)
+
+    def startGameSync(self):
+        #dealer is determined by seed
+        self.dealer = self.random.randrange(2)
+
+        #the whole deal is decided up front, the board just isn't in the infosets until its round
+        self.cards = tuple(self.random.sample(range(52), 9))
+        for i in range(2):
+            self.infosets[i] += ['hand'] + [CARD_NAMES[c] for c in self.getHand(i)]
+
+        if self.verbose:
+            print('hands', [[CARD_NAMES[c] for c in self.getHand(i)] for i in range(2)], file=self.file)
+
+        h = [copy.copy(self.history[0]), copy.copy(self.history[1])]
+        while len(h[0]) or len(h[1]):
+            player, req, actions = self.getTurnSync()
+            seed, actionIndex = h[player][0]
+            del h[player][0]
+            #ignore the seed, as the cards are already set
+            self.takeActionSync(player, actionIndex)
+
+    def getHand(self, player):
+        return self.cards[2 * player:2 * player + 2]
+
+    def getBoard(self):
+        return self.cards[4:9]
+
+    #forking lets cfr branch without replaying the whole history for every action
+    #a snapshot is everything that changes during a game
+    #cards are a tuple, so they don't need to be copied
+    def snapshot(self):
+        snap = (
+            self.dealer,
+            self.cards,
+            self.street,
+            copy.copy(self.pot),
+            self.numBets,
+            self.roundActions,
+            self.toAct,
+            self._winner,
+            self.scores,
+            copy.copy(self.curActions),
+            self.curPlayer,
+            [copy.copy(self.infosets[0]), copy.copy(self.infosets[1])],
+            [copy.copy(self.prevTrajectories[0]), copy.copy(self.prevTrajectories[1])] if self.saveTrajectories else None,
+        )
+        return snap
+
+    #puts the game back into the state from snapshot()
+    #the snapshot can be restored any number of times
+    def restore(self, snap):
+        (self.dealer, self.cards, self.street, pot, self.numBets, self.roundActions, self.toAct, self._winner,
+                self.scores, curActions, self.curPlayer, infosets, prevTrajectories) = snap
+        self.pot = copy.copy(pot)
+        self.curActions = copy.copy(curActions)
+        self.infosets = [copy.copy(infosets[0]), copy.copy(infosets[1])]
+        if self.saveTrajectories:
+            self.prevTrajectories = [copy.copy(prevTrajectories[0]), copy.copy(prevTrajectories[1])]
+
+        #the old winner might have been set by the branch we're rewinding
+        self.result = None
+        self._winnerFuture = None
+
+    #makes an independent copy of the game in its current state
+    def fork(self):
+        game = Game(history=self.history, seed=self.seed, saveTrajectories=self.saveTrajectories, verbose=self.verbose, file=self.file)
+        game.random.setstate(self.random.getstate())
+        game.restore(self.snapshot())
+        return game
+
+    def getTurnSync(self):
+        if self.street == _Game.START:
+            self.curActions = [[_Game.DEAL]]
+            self.curPlayer = self.dealer
+            return (self.dealer, {}, self.curActions)
+
+        if self.street == _Game.END:
+            if self._winner == None:
+                #showdown
+                if self.scores is None:
+                    self.scores = [evaluate(self.getHand(i) + self.getBoard()) for i in range(2)]
+                if self.verbose:
+                    for i in range(2):
+                        print('player', i+1, 'shows', CATEGORY_NAMES[getCategory(self.scores[i])], file=self.file)
+                if self.scores[0] == self.scores[1]:
+                    #split pot
+                    if self.verbose:
+                        print('tie', file=self.file)
+                    self.setResult((-1, 0))
+                    self.curPlayer = 0
+                    self.curActions = []
+                    return (0, {'win': 0}, [])
+                winner = 0 if self.scores[0] > self.scores[1] else 1
+            else:
+                winner = self._winner
+
+            loser = (winner + 1) % 2
+            winnings = self.pot[loser]
+            if self.verbose:
+                print('winner:', winner, 'winnings:', '$' + str(winnings), file=self.file)
+            self.setResult((winner, winnings))
+            self.curPlayer = winner
+            self.curActions = []
+            #normalize winnings to between -1 and 1
+            return (winner, {'win': winnings / MAX_WINNINGS}, [])
+
+        player = self.toAct
+        if self.pot[player] < self.pot[(player + 1) % 2]:
+            actions = [[_Game.FOLD], [_Game.CALL]]
+        else:
+            #check or bet
+            actions = [[_Game.CALL]]
+        if self.numBets < MAX_BETS:
+            actions.append([_Game.RAISE])
+
+        self.curActions = actions
+        self.curPlayer = player
+
+        return (player, {}, actions)
+
+    def getInfoset(self, player):
+        if player == self.curPlayer:
+            infoContext = ['OPTIONS']
+            for i, action in enumerate(self.curActions):
+                infoContext.append('@' + str(i))
+                infoContext += action
+            return self.infosets[player] + infoContext
+        else:
+            return self.infosets[player]
+
+    def takeActionSync(self, player, actionIndex):
+        action = self.curActions[actionIndex][0]
+        if self.verbose:
+            print('player', player+1, 'takes action', action, file=self.file)
+            print('pot', self.pot, file=self.file)
+        if self.saveTrajectories:
+            self.prevTrajectories[player].append((copy.copy(self.getInfoset(player)), actionIndex, copy.copy(self.curActions)))
+
+        self.curActions = []
+        #all actions are public
+        for i in range(2):
+            #infosets are always in first person
+            p = 0 if i == player else 1
+            self.infosets[i] += [str(p), action]
+
+        other = (player + 1) % 2
+        if self.street == _Game.START:
+            if action == _Game.DEAL:
+                self.dealer = player
+                self.pot[player] = SMALL_BLIND
+                self.pot[other] = BIG_BLIND
+                self.street = _Game.PREFLOP
+                self.numBets = 1
+                self.roundActions = 0
+                #small blind goes first preflop
+                self.toAct = player
+            else:
+                panic()
+        elif action == _Game.FOLD:
+            self._winner = other
+            self.street = _Game.END
+        elif action == _Game.CALL:
+            self.pot[player] = self.pot[other]
+            self.roundActions += 1
+            #the round is over once both players have acted and the bets match
+            if self.roundActions >= 2:
+                self.nextStreet()
+            else:
+                self.toAct = other
+        elif action == _Game.RAISE:
+            betSize = SMALL_BET if self.street <= _Game.FLOP else BIG_BET
+            self.pot[player] = self.pot[other] + betSize
+            self.numBets += 1
+            self.roundActions += 1
+            self.toAct = other
+        else:
+            panic()
+
+    def nextStreet(self):
+        self.street += 1
+        if self.street > _Game.RIVER:
+            self.street = _Game.END
+            return
+        first, last = _Game.streetCards[self.street]
+        cards = [CARD_NAMES[c] for c in self.getBoard()[first:last]]
+        for i in range(2):
+            self.infosets[i] += [_Game.streetNames[self.street]] + cards
+        if self.verbose:
+            print(_Game.streetNames[self.street], cards, file=self.file)
+        self.numBets = 0
+        self.roundActions = 0
+        #the big blind goes first after preflop
+        self.toAct = (self.dealer + 1) % 2
+
+if __name__ == '__main__':
+    #throughput benchmark for the hand evaluator and the game
+    import time
+
+    rng = np.random.default_rng()
+    num = 200000
+    hands = np.argsort(rng.random((num, 52)), axis=1)[:, 0:7]
+    handLists = hands.tolist()
+
+    start = time.time()
+    scores = [evaluate(hand) for hand in handLists]
+    print('hand evaluations per second:', round(num / (time.time() - start)))
+
+    start = time.time()
+    batchScores = evaluateBatch(hands)
+    print('batched hand evaluations per second:', round(num / (time.time() - start)))
+    if list(batchScores) != scores:
+        print('ERROR batched scores differ', file=sys.stderr)
+
+    #should be close to the actual 7 card odds
+    #straight flush 0.03%, quads 0.17%, full house 2.6%, flush 3.0%, straight 4.6%, trips 4.8%, two pair 23.5%, pair 43.8%, high card 17.4%
+    counts = np.bincount([getCategory(score) for score in scores], minlength=len(CATEGORY_NAMES))
+    for name, count in zip(CATEGORY_NAMES, counts):
+        print(name, '%.2f%%' % (100 * count / num))
 
-#TODO
+    #random games, stepped synchronously so this only times the game
+    numGames = 50000
+    numNodes = 0
+    numShowdowns = 0
+    start = time.time()
+    for i in range(numGames):
+        game = Game(seed=getSeed())
+        game.startGameSync()
+        while True:
+            player, req, actions = game.getTurnSync()
+            numNodes += 1
+            if 'win' in req:
+                numShowdowns += game.scores is not None
+                break
+            #mostly call, so more games get to showdown
+            if [_Game.CALL] in actions and random.random() < 0.7:
+                game.takeActionSync(player, actions.index([_Game.CALL]))
+            else:
+                game.takeActionSync(player, random.randrange(len(actions)))
+    elapsed = time.time() - start
+    print('random games per second:', round(numGames / elapsed), 'nodes per second:', round(numNodes / elapsed),
+            'showdowns:', '%.1f%%' % (100 * numShowdowns / numGames))
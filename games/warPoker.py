@@ -1,5 +1,6 @@
 import asyncio
 import copy
+import numpy as np
 import random
 import sys
 
@@ -8,6 +9,13 @@ import sys
 
 numActions = 4
 
+#nothing in the game waits on anything, so Game's async methods just wrap synchronous versions
+#BatchGame's check and the benchmarks below use those directly
+
+#both players' infosets have both cards and every action, so together they determine the game state
+#deepcfr's transposition table depends on this
+infosetsDetermineState = True
+
 #don't need a context, so this is empty
 class _Context:
     async def __aenter__(self):
@@ -99,8 +107,10 @@ class Game:
         self.hands = [0, 0]
         self.state = _Game.START
 
-        loop = asyncio.get_event_loop()
-        self.winner = loop.create_future()
+        #(winner, winnings) once the game is over
+        self.result = None
+        #only made if something awaits the winner, traversals don't need it
+        self._winnerFuture = None
         self._winner = None
 
         if self.saveTrajectories:
@@ -111,7 +121,31 @@ class Game:
         self.verbose = verbose
         self.infosets = [['start'],['start']]
 
+    #future for (winner, winnings)
+    @property
+    def winner(self):
+        if self._winnerFuture is None:
+            loop = asyncio.get_event_loop()
+            self._winnerFuture = loop.create_future()
+            if self.result is not None:
+                self._winnerFuture.set_result(self.result)
+        return self._winnerFuture
+
+    def setResult(self, result):
+        self.result = result
+        if self._winnerFuture is not None and not self._winnerFuture.done():
+            self._winnerFuture.set_result(result)
+
     async def startGame(self):
+        self.startGameSync()
+
+    async def getTurn(self):
+        return self.getTurnSync()
+
+    async def takeAction(self, player, actionIndex):
+        self.takeActionSync(player, actionIndex)
+
+    def startGameSync(self):
         #dealer is determined by seed
         self.dealer = self.random.randrange(2)
 
@@ -125,13 +159,56 @@ class Game:
 
         h = [copy.copy(self.history[0]), copy.copy(self.history[1])]
         while len(h[0]) or len(h[1]):
-            player, req, actions = await self.getTurn()
+            player, req, actions = self.getTurnSync()
             seed, actionIndex = h[player][0]
             del h[player][0]
             #ignore the seed, as the cards are already set
-            await self.takeAction(player, actionIndex)
+            self.takeActionSync(player, actionIndex)
+
+    #forking lets cfr branch without replaying the whole history for every action
+    #a snapshot is everything that changes during a game
+    #deck and hands are dealt in startGame, so they're included too
+    def snapshot(self):
+        snap = (
+            self.dealer,
+            copy.copy(self.pot),
+            self.bet,
+            copy.copy(self.hands),
+            copy.copy(self.deck),
+            self.state,
+            self._winner,
+            copy.copy(self.curActions),
+            getattr(self, 'curPlayer', None),
+            [copy.copy(self.infosets[0]), copy.copy(self.infosets[1])],
+            [copy.copy(self.prevTrajectories[0]), copy.copy(self.prevTrajectories[1])] if self.saveTrajectories else None,
+        )
+        return snap
+
+    #puts the game back into the state from snapshot()
+    #the snapshot can be restored any number of times
+    def restore(self, snap):
+        (self.dealer, pot, self.bet, hands, deck, self.state, self._winner,
+                curActions, self.curPlayer, infosets, prevTrajectories) = snap
+        self.pot = copy.copy(pot)
+        self.hands = copy.copy(hands)
+        self.deck = copy.copy(deck)
+        self.curActions = copy.copy(curActions)
+        self.infosets = [copy.copy(infosets[0]), copy.copy(infosets[1])]
+        if self.saveTrajectories:
+            self.prevTrajectories = [copy.copy(prevTrajectories[0]), copy.copy(prevTrajectories[1])]
 
-    async def getTurn(self):
+        #the old winner might have been set by the branch we're rewinding
+        self.result = None
+        self._winnerFuture = None
+
+    #makes an independent copy of the game in its current state
+    def fork(self):
+        game = Game(history=self.history, seed=self.seed, saveTrajectories=self.saveTrajectories, verbose=self.verbose, file=self.file)
+        game.random.setstate(self.random.getstate())
+        game.restore(self.snapshot())
+        return game
+
+    def getTurnSync(self):
         if self.state == _Game.START:
             self.curActions = [[_Game.DEAL]]
             self.curPlayer = self.dealer
@@ -146,7 +223,7 @@ class Game:
             winnings = self.pot[loser]
             if self.verbose:
                 print('winner:', self._winner, 'winnings:', '$' + str(winnings), file=self.file)
-            self.winner.set_result((self._winner, winnings))
+            self.setResult((self._winner, winnings))
             self.curPlayer = self._winner
             self.curActions = []
             #normalize winnings to between -1 and 1
@@ -175,7 +252,7 @@ class Game:
         else:
             return self.infosets[player]
 
-    async def takeAction(self, player, actionIndex):
+    def takeActionSync(self, player, actionIndex):
         action = self.curActions[actionIndex][0]
         if self.verbose:
             print('player', player+1, 'takes action', action, file=self.file)
@@ -238,3 +315,251 @@ class Game:
         else:
             panic()
 
+#many games advanced in lockstep, with the state in numpy arrays instead of a Game each
+#same rules and infosets as Game, but without the event loop
+#getTurn and takeAction work on every game at once, so a driver can step thousands of games per call
+#there's no history replay, and finished games just stay finished
+
+#action codes, in the order of the old enumActionDict
+BATCH_ACTIONS = [_Game.DEAL, _Game.FOLD, _Game.CALL, _Game.RAISE]
+_DEAL, _FOLD, _CALL, _RAISE = range(4)
+#-1 for no action
+_NONE = -1
+
+#tables indexed by [state, action index]
+#action codes for each state, same as _Game.actionDict (plus the deal)
+_stateActions = np.full((_Game.END + 1, 2), _NONE)
+_stateActions[_Game.START] = [_DEAL, _NONE]
+for _state, _actions in _Game.actionDict.items():
+    for _i, _action in enumerate(_actions):
+        _stateActions[_state, _i] = BATCH_ACTIONS.index(_action)
+_numActions = np.sum(_stateActions != _NONE, axis=1)
+
+#state after each action
+_nextStates = np.full((_Game.END + 1, 2), _Game.END)
+_nextStates[_Game.START, 0] = _Game.P1_DEAL
+_nextStates[_Game.P1_DEAL] = [_Game.P2_CHECK, _Game.P2_CALL]
+_nextStates[_Game.P2_CHECK] = [_Game.END, _Game.P1_RAISE]
+
+#whether the action matches the bet (i.e. a call after a raise)
+_paysBet = np.zeros((_Game.END + 1, 2), dtype=bool)
+_paysBet[_Game.P1_RAISE, 1] = True
+_paysBet[_Game.P2_CALL, 1] = True
+
+class BatchGame:
+    def __init__(self, numGames, seed=None):
+        self.numGames = numGames
+        self.random = np.random.default_rng(seed)
+        games = np.arange(numGames)
+        self.games = games
+
+        #dealer is random, like Game
+        self.dealer = self.random.integers(0, 2, numGames)
+        #two different cards from 2 through 14
+        first = self.random.integers(0, 13, numGames)
+        second = self.random.integers(0, 12, numGames)
+        second += second >= first
+        self.hands = np.stack([first, second], axis=1) + 2
+
+        #already anted up
+        self.pot = np.ones((numGames, 2), dtype=np.int64)
+        self.bet = np.zeros(numGames, dtype=np.int64)
+        self.state = np.full(numGames, _Game.START)
+        #-1 until someone folds or the game ends
+        self.winner = np.full(numGames, -1)
+
+        #(player, action code) for each action taken so far, for the infosets
+        #a game has at most 4 actions including the deal
+        self.actionPlayers = np.zeros((numGames, 4), dtype=np.int64)
+        self.actionCodes = np.zeros((numGames, 4), dtype=np.int64)
+        self.numTaken = np.zeros(numGames, dtype=np.int64)
+
+        self.curPlayer = np.zeros(numGames, dtype=np.int64)
+
+    #returns (player, win) arrays
+    #player is whose turn it is, or the winner for finished games
+    #win is nan for unfinished games, and the winnings normalized to between -1 and 1 for finished games
+    def getTurn(self):
+        ended = self.state == _Game.END
+
+        #only hand is a high card
+        showdown = ended & (self.winner == -1)
+        self.winner[showdown] = np.where(self.hands[showdown, 0] > self.hands[showdown, 1], 0, 1)
+
+        #p1 is the player after the dealer
+        p1Turn = (self.state == _Game.P1_DEAL) | (self.state == _Game.P1_RAISE)
+        player = np.where(p1Turn, (self.dealer + 1) % 2, self.dealer)
+        player = np.where(ended, self.winner, player)
+        self.curPlayer = player
+
+        win = np.full(self.numGames, np.nan)
+        loser = (self.winner[ended] + 1) % 2
+        win[ended] = self.pot[self.games[ended], loser] / 2
+        return player, win
+
+    #number of actions for each game, 0 for finished games
+    def getNumActions(self):
+        return _numActions[self.state]
+
+    #the actions for each game, like getTurn's actions
+    def getActions(self, i):
+        return [[BATCH_ACTIONS[code]] for code in _stateActions[self.state[i]] if code != _NONE]
+
+    #same as Game.getInfoset, for game i
+    def getInfoset(self, i, player):
+        infoset = ['start', 'hand', str(self.hands[i, player])]
+        for j in range(self.numTaken[i]):
+            #infosets are always in first person
+            infoset += ['0' if self.actionPlayers[i, j] == player else '1', BATCH_ACTIONS[self.actionCodes[i, j]]]
+        #like Game, the winner of a finished game gets OPTIONS with no actions after it
+        if player == self.curPlayer[i]:
+            infoset.append('OPTIONS')
+            for j, action in enumerate(self.getActions(i)):
+                infoset += ['@' + str(j), action[0]]
+        return infoset
+
+    #each game's current player's infoset, for batching network inputs
+    def getInfosets(self):
+        return [self.getInfoset(i, self.curPlayer[i]) for i in range(self.numGames)]
+
+    #takes actionIndices[i] in game i for the player from the last getTurn
+    #finished games are skipped
+    def takeAction(self, actionIndices):
+        active = self.games[self.state != _Game.END]
+        indices = actionIndices[active]
+        state = self.state[active]
+        player = self.curPlayer[active]
+        codes = _stateActions[state, indices]
+
+        taken = self.numTaken[active]
+        self.actionPlayers[active, taken] = player
+        self.actionCodes[active, taken] = codes
+        self.numTaken[active] += 1
+
+        #the dealer is whoever deals
+        deals = codes == _DEAL
+        self.dealer[active[deals]] = player[deals]
+
+        raises = codes == _RAISE
+        self.bet[active[raises]] += 1
+        pays = raises | _paysBet[state, indices]
+        self.pot[active[pays], player[pays]] += self.bet[active[pays]]
+
+        folds = codes == _FOLD
+        self.winner[active[folds]] = (player[folds] + 1) % 2
+
+        self.state[active] = _nextStates[state, indices]
+
+if __name__ == '__main__':
+    #benchmark for branching by replaying history vs branching from a snapshot
+    #this follows the shape of cfrRecur with every on player action expanded
+    #and a random off player action, just without the network
+    import time
+
+    async def traverse(game, seed, history, useSnapshot, onPlayer=0):
+        player, req, actions = await game.getTurn()
+        if 'win' in req:
+            return req['win'] if player == onPlayer else -1 * req['win']
+
+        if player != onPlayer:
+            actionIndex = random.randrange(len(actions))
+            await game.takeAction(player, actionIndex)
+            newHistory = copy.deepcopy(history)
+            newHistory[player].append((None, actionIndex))
+            return await traverse(game, seed, newHistory, useSnapshot, onPlayer)
+
+        snap = game.snapshot() if useSnapshot else None
+        total = 0
+        for i in range(len(actions)):
+            if i > 0 and useSnapshot:
+                game.restore(snap)
+            elif i > 0:
+                game = Game(seed=seed, history=history)
+                await game.startGame()
+                await game.getTurn()
+            await game.takeAction(player, i)
+            newHistory = copy.deepcopy(history)
+            newHistory[player].append((None, i))
+            total += await traverse(game, seed, newHistory, useSnapshot, onPlayer)
+        return total / len(actions)
+
+    async def benchmark(useSnapshot, num=20000):
+        start = time.time()
+        for i in range(num):
+            seed = getSeed()
+            game = Game(seed=seed)
+            await game.startGame()
+            await traverse(game, seed, [[],[]], useSnapshot, onPlayer=i % 2)
+        return num / (time.time() - start)
+
+    loop = asyncio.get_event_loop()
+    replayRate = loop.run_until_complete(benchmark(False))
+    snapshotRate = loop.run_until_complete(benchmark(True))
+    print('replay traversals per second:', round(replayRate))
+    print('snapshot traversals per second:', round(snapshotRate))
+    print('speedup:', round(snapshotRate / replayRate, 2))
+
+    #BatchGame has to give the same infosets and results as Game, including for finished games
+    def checkBatch(num=2000):
+        batch = BatchGame(num)
+        games = []
+        for i in range(num):
+            game = Game()
+            game.startGameSync()
+            #same deal as the batch
+            game.dealer = int(batch.dealer[i])
+            game.hands = [int(h) for h in batch.hands[i]]
+            game.infosets = [['start', 'hand', str(h)] for h in game.hands]
+            games.append(game)
+        rng = np.random.default_rng()
+        mismatches = 0
+        while True:
+            player, win = batch.getTurn()
+            for i, game in enumerate(games):
+                p, req, actions = game.getTurnSync()
+                if p != player[i] or ('win' in req) != (not np.isnan(win[i])) or ('win' in req and req['win'] != win[i]):
+                    mismatches += 1
+                for j in range(2):
+                    if game.getInfoset(j) != batch.getInfoset(i, j):
+                        mismatches += 1
+            if not np.isnan(win).any():
+                break
+            actionIndices = (rng.random(num) * batch.getNumActions()).astype(np.int64)
+            for i, game in enumerate(games):
+                if np.isnan(win[i]):
+                    game.takeActionSync(int(player[i]), int(actionIndices[i]))
+            batch.takeAction(actionIndices)
+        return mismatches
+
+    print('batch mismatches with Game:', checkBatch())
+
+    #benchmark for playing random games one at a time vs in lockstep with BatchGame
+    async def playGames(num):
+        start = time.time()
+        for i in range(num):
+            game = Game(seed=getSeed())
+            await game.startGame()
+            while True:
+                player, req, actions = await game.getTurn()
+                if 'win' in req:
+                    break
+                await game.takeAction(player, random.randrange(len(actions)))
+        return num / (time.time() - start)
+
+    def playBatch(num):
+        start = time.time()
+        batch = BatchGame(num)
+        rng = np.random.default_rng()
+        while True:
+            player, win = batch.getTurn()
+            if not np.isnan(win).any():
+                break
+            numActions = batch.getNumActions()
+            batch.takeAction((rng.random(num) * numActions).astype(np.int64))
+        return num / (time.time() - start)
+
+    gameRate = loop.run_until_complete(playGames(20000))
+    batchRate = playBatch(100000)
+    print('games per second one at a time:', round(gameRate))
+    print('games per second in lockstep:', round(batchRate))
+    print('speedup:', round(batchRate / gameRate, 2))
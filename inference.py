@@ -0,0 +1,366 @@
+import asyncio
+import collections
+import hashlib
+import numpy as np
+import os
+import threading
+import time
+import torch
+import torch.distributed as dist
+
+import config
+import model
+
+#network inputs are sent with their own tag
+#so the net process can post the irecv for the next header without it matching an input
+INPUT_TAG = 1
+
+#client side of the network evaluation protocol in nethandler
+#search processes use this to get advantages from the net process
+
+#send 2, player, size to request evaluation
+#then send the network input
+#then recv the results, followed by a 1 so we can tell when they've come in
+class InferenceClient:
+    def __init__(self, dst=0):
+        self.dst = dst
+
+        #(future, player, input tensor, start time) for requests that haven't been sent yet
+        self.outbox = collections.deque()
+        #wakes the sending thread up when there's something in the outbox
+        self.condition = threading.Condition()
+        self.thread = None
+        self.loop = None
+
+        #seconds between sending each request and getting its output
+        #since the last reset
+        self.latencies = []
+
+    #queues the request and returns a future for the network output
+    def request(self, player, inputTensor):
+        if self.thread is None:
+            self.loop = asyncio.get_event_loop()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        future = self.loop.create_future()
+        with self.condition:
+            self.outbox.append((future, player, inputTensor, time.time()))
+            self.condition.notify()
+        return future
+
+    #every call on the process group during a search goes through this thread
+    #torch.distributed doesn't promise that a group can be used from two threads at once
+    #the other messages (training, stopping) are only sent between iterations, when nothing is in flight
+    #gloo doesn't mark an irecv as completed until we wait on it, and waiting with a timeout closes the connection
+    #so this checks the flag at the end of the oldest output, sleeping for longer and longer while nothing comes back
+    def run(self):
+        #(future, output, irecv, isends, start time) for requests that are waiting on outputs, in the order they were sent
+        #the net process replies to each rank in order, so only the oldest request can finish next
+        pending = collections.deque()
+        sleepTime = 0
+        while True:
+            with self.condition:
+                if not self.outbox:
+                    #with nothing in flight, there's nothing to do until the next request
+                    self.condition.wait(sleepTime if pending else None)
+                requests = list(self.outbox)
+                self.outbox.clear()
+
+            for future, player, inputTensor, startTime in requests:
+                header = torch.tensor([2, player, inputTensor.shape[0]])
+                sends = [dist.isend(header, dst=self.dst), dist.isend(inputTensor, dst=self.dst, tag=INPUT_TAG)]
+                out = torch.zeros(config.game.numActions + 2)
+                recv = dist.irecv(out, src=self.dst)
+                pending.append((future, out, recv, sends, startTime))
+
+            done = 0
+            while pending and pending[0][1][-1].item() != 0:
+                future, out, recv, sends, startTime = pending.popleft()
+                #the flag is the last thing written, so these return right away
+                recv.wait()
+                for send in sends:
+                    send.wait()
+                self.latencies.append(time.time() - startTime)
+                self.loop.call_soon_threadsafe(self.resolve, future, out[0:-1].numpy())
+                done += 1
+
+            if requests or done:
+                sleepTime = 0
+            else:
+                sleepTime = min(2 * sleepTime + 0.00001, 0.001)
+
+    def resolve(self, future, out):
+        #the traversal waiting on this might have been cancelled
+        if not future.cancelled():
+            future.set_result(out)
+
+    #drop-in for the old blocking getPredict
+    async def predict(self, player, infoset):
+        out = await self.request(player, model.infosetToTensor(infoset))
+        return out[0:-1], out[-1]
+
+    #returns (count, mean, p50, p95, max) of request latencies in seconds
+    def getLatencyStats(self):
+        if not self.latencies:
+            return (0, 0, 0, 0, 0)
+        latencies = np.array(self.latencies)
+        return (len(latencies), latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 95), latencies.max())
+
+    def resetLatencyStats(self):
+        self.latencies = []
+
+#bounded LRU cache of network outputs for a search process
+#the advantage networks don't change during a search iteration
+#so repeated infosets don't need another trip to the net process
+class PredictCache:
+    def __init__(self, maxSize):
+        #max number of entries per player
+        self.maxSize = maxSize
+        #one cache per player, so retraining one player's network only clears that player's entries
+        self.caches = [collections.OrderedDict(), collections.OrderedDict()]
+        self.hits = 0
+        self.misses = 0
+
+    #python's hash() depends on PYTHONHASHSEED, so use something that doesn't
+    def getKey(self, infoset):
+        return hashlib.blake2b('\0'.join(infoset).encode('UTF-8'), digest_size=16).digest()
+
+    #returns None on a miss
+    def get(self, player, key):
+        if not self.maxSize:
+            return None
+        cache = self.caches[player]
+        value = cache.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            cache.move_to_end(key)
+        return value
+
+    def put(self, player, key, value):
+        if not self.maxSize:
+            return
+        cache = self.caches[player]
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.maxSize:
+            cache.popitem(last=False)
+
+    #call whenever the player's network is retrained
+    def invalidate(self, player):
+        self.caches[player].clear()
+
+    def resetStats(self):
+        self.hits = 0
+        self.misses = 0
+
+#shared memory transport
+#each search process gets a ring of request slots and a ring of response slots
+#search processes aren't children of the net process, so the rings are backed by files in /dev/shm
+#instead of being passed around by torch.multiprocessing
+
+#slot states, stored in the first column of the request ring
+FREE = 0
+REQUESTED = 1
+CLAIMED = 2
+RESPONDED = 3
+
+class ShmRing:
+    #the net process creates the rings before the search processes start
+    def __init__(self, rank, create=False):
+        self.rank = rank
+        self.numSlots = config.shmSlots
+        self.maxLength = config.shmMaxInfosetLength
+        self.width = 1 + model.NUM_TOKEN_BITS
+        self.outputSize = config.game.numActions + 1
+
+        path = config.shmPath + '-' + str(rank)
+        self.paths = [path + '-req', path + '-res']
+        #each request row is state, player, length, then the flattened infoset
+        self.requests = torch.from_file(path + '-req', shared=True, size=self.numSlots * (3 + self.maxLength * self.width), dtype=torch.long).view(self.numSlots, -1)
+        self.responses = torch.from_file(path + '-res', shared=True, size=self.numSlots * self.outputSize, dtype=torch.float).view(self.numSlots, -1)
+        if create:
+            #files might be left over from an old run
+            self.requests.zero_()
+            self.responses.zero_()
+
+        #numpy views of the same memory, scalar access is a lot cheaper through numpy
+        self.requestsNp = self.requests.numpy()
+        self.responsesNp = self.responses.numpy()
+        self.states = self.requestsNp[:, 0]
+
+    #removes the files, so they don't keep taking up memory in /dev/shm after the run
+    #anything that already has the ring open keeps its mapping
+    def unlink(self):
+        for path in self.paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    #search process side
+
+    def write(self, slot, player, inputTensor):
+        length = inputTensor.shape[0]
+        row = self.requestsNp[slot]
+        row[1] = player
+        row[2] = length
+        row[3:3 + length * self.width] = inputTensor.numpy().reshape(-1)
+        #state goes last so the net process never sees a partial request
+        row[0] = REQUESTED
+
+    def read(self, slot):
+        out = self.responsesNp[slot].copy()
+        self.states[slot] = FREE
+        return out
+
+    #net process side
+
+    #returns (slot, player, input tensor) for up to limit requested slots
+    #the input tensors are views into the ring, so nothing is copied
+    def claim(self, limit):
+        claimed = []
+        for slot in np.flatnonzero(self.states == REQUESTED)[:limit]:
+            row = self.requests[slot]
+            player = row[1].item()
+            length = row[2].item()
+            self.states[slot] = CLAIMED
+            claimed.append((slot, player, row[3:3 + length * self.width].view(length, self.width)))
+        return claimed
+
+    def hasRequests(self):
+        return bool(np.any(self.states == REQUESTED))
+
+    def respond(self, slot, out):
+        self.responsesNp[slot] = out.numpy()
+        self.states[slot] = RESPONDED
+
+#same interface as InferenceClient, but requests go through a ShmRing
+#infosets that are too long for a slot still go through gloo
+class ShmInferenceClient(InferenceClient):
+    def __init__(self, dst=0):
+        super().__init__(dst)
+        #opened on the first request, by which point the net process has created it
+        self.ring = None
+        self.nextSlot = 0
+        #(future, slot, start time) for requests in the ring, in the order they were written
+        self.slotPending = collections.deque()
+        #(future, player, input tensor, start time) for requests waiting on a free slot
+        self.backlog = collections.deque()
+        self.slotPollTask = None
+
+    def request(self, player, inputTensor):
+        if self.ring is None:
+            self.ring = ShmRing(dist.get_rank())
+        if inputTensor.shape[0] > self.ring.maxLength:
+            return super().request(player, inputTensor)
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.backlog.append((future, player, inputTensor, time.time()))
+        self.fillSlots()
+
+        if self.slotPollTask is None or self.slotPollTask.done():
+            self.slotPollTask = asyncio.ensure_future(self.slotPoll())
+        return future
+
+    #moves requests from the backlog into free slots
+    def fillSlots(self):
+        while self.backlog and self.ring.states[self.nextSlot] == FREE:
+            future, player, inputTensor, startTime = self.backlog.popleft()
+            self.ring.write(self.nextSlot, player, inputTensor)
+            self.slotPending.append((future, self.nextSlot, startTime))
+            self.nextSlot = (self.nextSlot + 1) % self.ring.numSlots
+
+    #there's nothing to block on, so this sleeps for longer and longer while nothing comes back
+    #like nethandler.waitForWork, so an idle search process doesn't burn a core
+    async def slotPoll(self):
+        sleepTime = 0
+        while self.slotPending or self.backlog:
+            if self.slotPending and self.ring.states[self.slotPending[0][1]] == RESPONDED:
+                future, slot, startTime = self.slotPending.popleft()
+                out = self.ring.read(slot)
+                self.latencies.append(time.time() - startTime)
+                if not future.cancelled():
+                    future.set_result(out)
+                self.fillSlots()
+                sleepTime = 0
+            else:
+                await asyncio.sleep(sleepTime)
+                sleepTime = min(2 * sleepTime + 0.00001, 0.001)
+
+#the client for the configured transport
+def getClient():
+    if config.inferenceTransport == 'shm':
+        return ShmInferenceClient()
+    else:
+        return InferenceClient()
+
+if __name__ == '__main__':
+    #benchmark of the gloo and shared memory transports
+    #the net process runs the real nethandler loop, but with a network that just returns zeros
+    #so this only measures the transport and batching
+    import datetime
+    import os
+    import sys
+    import torch.multiprocessing as mp
+
+    import nethandler
+
+    numProcesses = 3
+    numRequests = 2000
+    numInFlight = 16
+    infosetLength = 32
+
+    class _ZeroModel:
+        def batchPredict(self, infosets, convertToTensor=False):
+            return torch.zeros(len(infosets), config.game.numActions + 1)
+
+    class _Agent:
+        advModels = [_ZeroModel(), _ZeroModel()]
+        oldModels = [[], []]
+
+    def runProcess(pid, transport, port):
+        config.inferenceTransport = transport
+        os.environ['MASTER_ADDR'] = '127.0.0.1'
+        os.environ['MASTER_PORT'] = str(port)
+        dist.init_process_group('gloo', timeout=datetime.timedelta(0, 600), rank=pid, world_size=numProcesses)
+        workerGroup = dist.new_group(ranks=list(range(1, numProcesses)))
+        if pid == 0:
+            rings = [ShmRing(rank, create=True) for rank in range(1, numProcesses)] if transport == 'shm' else []
+            dist.barrier()
+            try:
+                asyncio.get_event_loop().run_until_complete(nethandler.run(_Agent(), numProcesses, rings=rings))
+            finally:
+                for ring in rings:
+                    ring.unlink()
+            dist.barrier()
+        else:
+            dist.barrier()
+            client = getClient()
+            infoset = ['token'] * infosetLength
+            requestNums = iter(range(numRequests))
+            async def runRequests():
+                for i in requestNums:
+                    await client.predict(i % 2, infoset)
+            async def runAll():
+                await asyncio.gather(*[runRequests() for i in range(numInFlight)])
+            start = time.time()
+            asyncio.get_event_loop().run_until_complete(runAll())
+            elapsed = time.time() - start
+            count, mean, p50, p95, maxLatency = client.getLatencyStats()
+            print(transport, 'rank', pid, 'requests per second', round(numRequests / elapsed),
+                    'latency ms p50', round(p50 * 1000, 3), 'p95', round(p95 * 1000, 3), file=sys.stderr)
+            #everyone has to be done before we stop the net process
+            dist.barrier(workerGroup)
+            if pid == 1:
+                dist.send(torch.zeros(3, dtype=torch.long), dst=0)
+            dist.barrier()
+
+    for port, transport in [(29510, 'gloo'), (29511, 'shm')]:
+        processes = [mp.Process(target=runProcess, args=(pid, transport, port)) for pid in range(numProcesses)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
@@ -2,6 +2,8 @@
 
 from apex import amp
 from hashembed.embedding import HashEmbedding
+import collections
+import hashlib
 import io
 import itertools
 import math
@@ -18,6 +20,7 @@ from torch.utils.data.sampler import SubsetRandomSampler
 import torchvision.transforms as transforms
 from batchgenerators.dataloading import MultiThreadedAugmenter
 import time
+import weakref
 
 import dataStorage
 import config
@@ -53,21 +56,110 @@ def numToBinary(n):
 
 #used to map each token in an infoset into an int representation
 #the first number is used for embedding, and the other numbers are for binary numbers
-numberMap = {}
-def tokenToTensor(x):
-    if not numberMap:
-        for i in range(1 << NUM_TOKEN_BITS):
-            numberMap[str(i)] = numToBinary(i)
+#every token gets interned into a row of tokenTable the first time we see it
+#so hashing and numToBinary only happen once per distinct token
+tokenRows = {}
+tokenTable = np.zeros((1024, 1 + NUM_TOKEN_BITS), dtype=np.int64)
+
+#tokens that aren't numbers get the bits for '0'
+numberMap = {str(i): numToBinary(i).numpy() for i in range(1 << NUM_TOKEN_BITS)}
+
+def _internToken(x):
+    global tokenTable
+    row = len(tokenRows)
+    if row == tokenTable.shape[0]:
+        tokenTable = np.concatenate([tokenTable, np.zeros_like(tokenTable)])
+    tokenTable[row, 0] = hash(x) % config.vocabSize
+    tokenTable[row, 1:] = numberMap.get(x, numberMap['0'])
+    tokenRows[x] = row
+    return row
+
+#table rows for each token, interning any new ones
+def _getRows(tokens):
+    get = tokenRows.get
+    rows = [get(token) for token in tokens]
+    if None in rows:
+        for i, token in enumerate(tokens):
+            if rows[i] is None:
+                #a new token can show up more than once, so check again before interning
+                rows[i] = get(token)
+                if rows[i] is None:
+                    rows[i] = _internToken(token)
+    return rows
 
-    if x in numberMap:
-        return torch.tensor([hash(x) % config.vocabSize, *numberMap[x]])
-    else:
-        return torch.tensor([hash(x) % config.vocabSize, *numberMap['0']])
+def tokenToTensor(x):
+    row = _getRows([x])[0]
+    return torch.from_numpy(tokenTable[row].copy())
 
 #formats the infoset so it can be processed by the network
 #this is how infosets should be stored
 def infosetToTensor(infoset):
-    return torch.stack([tokenToTensor(token) for token in infoset])
+    #interning can replace tokenTable, so get the rows first
+    rows = _getRows(infoset)
+    return torch.from_numpy(tokenTable[rows])
+
+#same as [infosetToTensor(infoset) for infoset in infosets]
+#but the whole batch comes out of the table at once
+#the tensors are views of one array
+def infosetsToTensors(infosets):
+    rows = _getRows([token for infoset in infosets for token in infoset])
+    out = torch.from_numpy(tokenTable[rows])
+    return list(out.split([len(infoset) for infoset in infosets]))
+
+#cache of lstm states for infoset prefixes
+#infosets along a traversal are the previous infoset plus a few tokens
+#so only those new tokens need to go through the lstm
+#prefixes are cut every chunkSize tokens, and each key covers every chunk before it too
+class PrefixCache:
+    def __init__(self, maxSize, chunkSize):
+        self.maxSize = maxSize
+        self.chunkSize = chunkSize
+        #key => (h, c) with shape (num layers, lstm size)
+        self.states = collections.OrderedDict()
+        #number of tokens we didn't have to run through the lstm
+        self.tokensSkipped = 0
+        self.tokensRun = 0
+
+    #key for each of the first numChunks chunks of the infoset tensor
+    def getKeys(self, infoset, numChunks):
+        data = infoset.numpy()
+        keys = []
+        key = b''
+        for i in range(numChunks):
+            key = hashlib.blake2b(key + data[i * self.chunkSize:(i + 1) * self.chunkSize].tobytes(), digest_size=16).digest()
+            keys.append(key)
+        return keys
+
+    #returns (number of tokens, state) for the longest cached prefix
+    #or (0, None) if nothing is cached
+    def lookup(self, keys):
+        for i in range(len(keys) - 1, -1, -1):
+            state = self.states.get(keys[i])
+            if state is not None:
+                self.states.move_to_end(keys[i])
+                return (i + 1) * self.chunkSize, state
+        return 0, None
+
+    def put(self, key, state):
+        self.states[key] = state
+        self.states.move_to_end(key)
+        while len(self.states) > self.maxSize:
+            self.states.popitem(last=False)
+
+#one prefix cache per network
+#the cached states are only valid for the weights that made them
+#so a new network gets a new cache, and a retrained network has its cache dropped
+prefixCaches = weakref.WeakKeyDictionary()
+
+#returns None if the network can't use a prefix cache right now
+def getPrefixCache(net):
+    if not config.prefixCacheSize or config.enableCnn or config.enableAttention or net.training:
+        return None
+    prefixCache = prefixCaches.get(net)
+    if prefixCache is None:
+        prefixCache = PrefixCache(config.prefixCacheSize, config.prefixCacheChunk)
+        prefixCaches[net] = prefixCache
+    return prefixCache
 
 #model of the network
 class LstmNet(nn.Module):
@@ -135,20 +227,7 @@ class LstmNet(nn.Module):
             isSingle = True
             infoset = infoset[None, :, :]
 
-        #embed the word hash, which is the first element
-        if trace:
-            print('infoset', infoset, file=sys.stderr)
-        embedded = self.embeddings(infoset[:,:,0])
-        #embedding seems to spit out some pretty low-magnitude vectors
-        #so let's try normalizing
-        #embedded = F.normalize(embedded, p=2, dim=2)
-        if trace:
-            print('embedded', embedded, file=sys.stderr)
-
-        embedded = self.dropout(embedded)
-        #replace the hash with the embedded vector
-        x = torch.cat((embedded, infoset[:,:, 1:].to(dtype=embedded.dtype)), 2)
-        #del infoset
+        x = self.embed(infoset, trace=trace)
 
         #go through a couple conv layers
         #need to mask out the part proportional to the initial lengths in the conv output
@@ -262,6 +341,32 @@ class LstmNet(nn.Module):
         else:
             x = lasts
 
+        x = self.head(x, trace=trace)
+        if isSingle:
+            return x[0]
+        else:
+            return x
+
+    #turns a batch of infoset tensors into lstm inputs
+    def embed(self, infoset, trace=False):
+        #embed the word hash, which is the first element
+        if trace:
+            print('infoset', infoset, file=sys.stderr)
+        embedded = self.embeddings(infoset[:,:,0])
+        #embedding seems to spit out some pretty low-magnitude vectors
+        #so let's try normalizing
+        #embedded = F.normalize(embedded, p=2, dim=2)
+        if trace:
+            print('embedded', embedded, file=sys.stderr)
+
+        embedded = self.dropout(embedded)
+        #replace the hash with the embedded vector
+        x = torch.cat((embedded, infoset[:,:, 1:].to(dtype=embedded.dtype)), 2)
+        #del infoset
+        return x
+
+    #turns the lstm (or attention) output into advantages and the value
+    def head(self, x, trace=False):
         x = self.lstmDropout(x)
 
         if trace:
@@ -287,11 +392,52 @@ class LstmNet(nn.Module):
         xVal = F.relu(self.fcVal2(xVal) + xVal)
         xVal = self.fcValOut(xVal)
 
-        if isSingle:
-            return torch.cat([x[0], xVal[0]])
-        else:
-            x = torch.cat([x, xVal], dim=1)
-            return x
+        return torch.cat([x, xVal], dim=1)
+
+    #forward pass for a list of unpadded infosets that reuses lstm states from prefixCache
+    #each infoset runs from its longest cached prefix to its last chunk boundary, then to the end
+    #the state at the boundary is cached for later infosets with the same prefix
+    #only valid without cnn or attention, as those need the whole sequence
+    def forwardCached(self, infosets, prefixCache):
+        chunkSize = prefixCache.chunkSize
+        #(start, boundary, key at boundary, state at start) for each infoset
+        plans = []
+        for infoset in infosets:
+            #always leave at least one token after the boundary, so the boundary state gets used
+            boundary = (infoset.shape[0] - 1) // chunkSize * chunkSize
+            keys = prefixCache.getKeys(infoset.cpu(), boundary // chunkSize)
+            start, state = prefixCache.lookup(keys)
+            prefixCache.tokensSkipped += start
+            prefixCache.tokensRun += infoset.shape[0] - start
+            plans.append((start, boundary, keys[-1] if keys else None, state))
+
+        #run up to the boundaries, for the infosets that aren't already there
+        states = [state for start, boundary, key, state in plans]
+        toBoundary = [i for i, (start, boundary, key, state) in enumerate(plans) if start < boundary]
+        if toBoundary:
+            h, c = self._runLstm([infosets[i][plans[i][0]:plans[i][1]] for i in toBoundary], [states[i] for i in toBoundary])
+            for j, i in enumerate(toBoundary):
+                states[i] = (h[:, j].clone(), c[:, j].clone())
+                prefixCache.put(plans[i][2], states[i])
+
+        #then the rest of the way
+        h, c = self._runLstm([infoset[boundary:] for infoset, (start, boundary, key, state) in zip(infosets, plans)], states)
+        #the final hidden state of the top layer is the last lstm output
+        return self.head(h[-1])
+
+    #runs the lstm over the sequences starting from the given (h, c) states
+    #None starts from zeros like a normal forward pass
+    #returns the final (h, c) for every sequence
+    def _runLstm(self, sequences, states):
+        device = sequences[0].device
+        lengths = torch.tensor([len(s) for s in sequences])
+        x = self.embed(torch.nn.utils.rnn.pad_sequence(sequences, batch_first=True))
+        zeros = torch.zeros(self.lstm.num_layers, self.lstm.hidden_size, device=device, dtype=x.dtype)
+        h0 = torch.stack([state[0] if state is not None else zeros for state in states], dim=1)
+        c0 = torch.stack([state[1] if state is not None else zeros for state in states], dim=1)
+        x = torch.nn.utils.rnn.pack_padded_sequence(x, lengths, batch_first=True, enforce_sorted=False)
+        _, (h, c) = self.lstm(x, (h0, c0))
+        return h, c
 
 
 
@@ -325,6 +471,102 @@ def myCollate(batch):
     return padded, lengths, labels, iters
 
 
+#padded forward pass of a list of infoset tensors through net
+#returns one row of outputs per infoset, in the same order
+def batchForward(net, batch, device, trace=False):
+    if len(batch) > 1:
+        #sort, but need to keep trach of the original indices
+        batch = list(enumerate(batch))
+        batch.sort(key=lambda x: len(x[1]), reverse=True)
+        indices = torch.tensor([b[0] for b in batch], dtype=torch.long).to(device)
+        #print('indices', indices)
+        #no longer need indices in batch
+        batch = [b[1] for b in batch]
+        #print('batch after sorting', batch, file=sys.stderr)
+        #sort by length and padd
+        lengths = [len(b) for b in batch]
+        padded = torch.zeros(len(batch), max(lengths), len(batch[0][0]), dtype=torch.long).to(device)
+        for i, d in enumerate(batch):
+            end = lengths[i]
+            padded[i, :end] = d[:end]
+        #pass padded to network
+        lengths = torch.tensor(lengths).to(device)
+        #padded = padded.to(device)
+        #lengths = lengths.to(device)
+        #print('padded', padded, file=sys.stderr)
+        #print('lengths', lengths, file=sys.stderr)
+        out = net(padded, lengths=lengths, trace=trace)#.float()
+        #unsort with scatter
+        unsortedOut = torch.zeros(out.shape).to(device).to(dtype=out.dtype)
+        #print('out', out)
+        indices = indices.unsqueeze(1).expand(-1, out.shape[1])
+        #print('expaned indices', indices)
+        unsortedOut.scatter_(0, indices, out)
+        return unsortedOut.cpu()
+    else:
+        batch[0] = batch[0].to(device)
+        out = net(batch[0], trace=trace)
+        return out.unsqueeze(0).float()
+
+#evaluates a list of networks on the same infosets
+#used for the single deep cfr ensemble, where every old network gets evaluated on every infoset of a trajectory
+#torch.func.vmap can't batch nn.LSTM, so the lstm layers are run by hand with the weights stacked
+#that's one set of batched matrix multiplies per time step for every network
+#instead of a separate forward pass for each network and infoset
+#embeddings and the fully connected head are cheap, so they still run per network
+class NetEnsemble:
+    def __init__(self, nets):
+        self.nets = nets
+        #the hand written lstm doesn't do cnn or attention
+        #it's mostly a win on the gpu, where separate forward passes are bound by kernel launches
+        self.grouped = config.groupedEnsemble and len(nets) > 1 and not config.enableCnn and not config.enableAttention
+        if not self.grouped:
+            return
+        #(input weights, hidden weights, bias) for each layer, stacked across networks
+        self.layers = []
+        with torch.no_grad():
+            for layer in range(nets[0].lstm.num_layers):
+                wih = torch.stack([getattr(net.lstm, 'weight_ih_l' + str(layer)).float() for net in nets])
+                whh = torch.stack([getattr(net.lstm, 'weight_hh_l' + str(layer)).float() for net in nets])
+                bias = torch.stack([(getattr(net.lstm, 'bias_ih_l' + str(layer)) + getattr(net.lstm, 'bias_hh_l' + str(layer))).float() for net in nets])
+                self.layers.append((wih.transpose(1, 2), whh.transpose(1, 2), bias))
+
+    #returns a numpy array of outputs with shape (number of networks, number of infosets, number of actions + 1)
+    def predict(self, infosets, convertToTensor=True):
+        batch = infosetsToTensors(infosets) if convertToTensor else infosets
+        device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+        with torch.no_grad():
+            if not self.grouped:
+                #one padded forward pass per network
+                return torch.stack([batchForward(net.to(device), [b.to(device) for b in batch], device).float().cpu() for net in self.nets]).numpy()
+            return self._groupedForward(batch, device).cpu().numpy()
+
+    def _groupedForward(self, batch, device):
+        lengths = torch.tensor([len(b) for b in batch], device=device)
+        padded = torch.nn.utils.rnn.pad_sequence([b.to(device) for b in batch], batch_first=True)
+        #(networks, batch, time, input)
+        x = torch.stack([net.to(device).embed(padded).float() for net in self.nets])
+        numNets, batchSize, numSteps, _ = x.shape
+        for wih, whh, bias in self.layers:
+            wih, whh, bias = wih.to(device), whh.to(device), bias.to(device)
+            hiddenSize = whh.shape[1]
+            #the input side of every gate can be done for every time step at once
+            xGates = torch.matmul(x.reshape(numNets, batchSize * numSteps, -1), wih).view(numNets, batchSize, numSteps, -1) + bias[:, None, None, :]
+            h = torch.zeros(numNets, batchSize, hiddenSize, device=device)
+            c = torch.zeros(numNets, batchSize, hiddenSize, device=device)
+            outputs = []
+            for t in range(numSteps):
+                gates = xGates[:, :, t] + torch.bmm(h, whh)
+                #same gate order as nn.LSTM
+                i, f, g, o = gates.chunk(4, dim=2)
+                c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+                h = torch.sigmoid(o) * torch.tanh(c)
+                outputs.append(h)
+            x = torch.stack(outputs, dim=2)
+        #padding only comes after each infoset, so the output at the last real token is the same as without padding
+        lasts = x[:, torch.arange(batchSize, device=device), lengths - 1]
+        return torch.stack([net.head(lasts[n].to(dtype=net.fc1.weight.dtype)).float() for n, net in enumerate(self.nets)])
+
 class DeepCfrModel:
 
     #for advantages, the input is the state vector
@@ -403,52 +645,34 @@ class DeepCfrModel:
             path = self.saveFile + 'model.' + self.name  + '.' + str(n) + '.pt'
             print('loading model', path, file=sys.stderr)
             self.net.load_state_dict(torch.load(path))
+            prefixCaches.pop(self.net, None)
             self.net.eval()
 
     #infosets is a list of tensors
     def batchPredict(self, infosets, convertToTensor=True, trace=False):
         #print('infosets', infosets)
-        batch = [infosetToTensor[i] for i in infosets] if convertToTensor else infosets
+        batch = infosetsToTensors(infosets) if convertToTensor else infosets
         device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
         self.net = self.net.to(device)
         batch = [b.to(device) for b in batch]
-        if len(batch) > 1:
-            #sort, but need to keep trach of the original indices
-            batch = list(enumerate(batch))
-            batch.sort(key=lambda x: len(x[1]), reverse=True)
-            indices = torch.tensor([b[0] for b in batch], dtype=torch.long).to(device)
-            #print('indices', indices)
-            #no longer need indices in batch
-            batch = [b[1] for b in batch]
-            #print('batch after sorting', batch, file=sys.stderr)
-            #sort by length and padd
-            lengths = [len(b) for b in batch]
-            padded = torch.zeros(len(batch), max(lengths), len(batch[0][0]), dtype=torch.long).to(device)
-            for i, d in enumerate(batch):
-                end = lengths[i]
-                padded[i, :end] = d[:end]
-            #pass padded to network
-            lengths = torch.tensor(lengths).to(device)
-            #padded = padded.to(device)
-            #lengths = lengths.to(device)
-            #print('padded', padded, file=sys.stderr)
-            #print('lengths', lengths, file=sys.stderr)
-            out = self.net(padded, lengths=lengths, trace=trace)#.float()
-            #unsort with scatter
-            unsortedOut = torch.zeros(out.shape).to(device).to(dtype=out.dtype)
-            #print('out', out)
-            indices = indices.unsqueeze(1).expand(-1, out.shape[1])
-            #print('expaned indices', indices)
-            unsortedOut.scatter_(0, indices, out)
-            return unsortedOut.cpu()
-        else:
-            batch[0] = batch[0].to(device)
-            out = self.net(batch[0], trace=trace)
-            return out.unsqueeze(0).float()
 
+        prefixCache = getPrefixCache(self.net)
+        if prefixCache is not None and not trace:
+            with torch.no_grad():
+                out = self.net.forwardCached(batch, prefixCache).float()
+                if config.verifyPrefixCache:
+                    full = batchForward(self.net, batch, device).float()
+                    if not torch.allclose(out, full, rtol=1e-3, atol=1e-3):
+                        print('prefix cache output differs from full output by', (out - full).abs().max().item(), file=sys.stderr)
+            return out.cpu()
+
+        return batchForward(self.net, batch, device, trace=trace)
 
     def predict(self, infoset, convertToTensor=True, trace=False):
         data = infosetToTensor(infoset) if convertToTensor else infoset
+        if getPrefixCache(self.net) is not None and not trace:
+            data = self.batchPredict([data], convertToTensor=False)[0].detach().numpy()
+            return data[0:-1], data[-1]
         device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
         #device = torch.device('cpu')
         self.net = self.net.to(device)
@@ -469,6 +693,9 @@ class DeepCfrModel:
         #move from write cache to db
         self.clearSampleCache()
 
+        #the cached lstm states won't match the new weights
+        prefixCaches.pop(self.net, None)
+
         device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
         #device = torch.device('cpu')
 
@@ -729,3 +956,15 @@ if __name__ == '__main__':
     x = torch.sum(x, dim=1)#again, we'd use l1 here
     x = SlicedLstmNet.unsort(x, i1)
     print(x)
+
+    #benchmark for tokenization on pokemon sized infosets
+    import random
+    tokens = ['token' + str(i) for i in range(3000)] + [str(i) for i in range(20)]
+    infosets = [[random.choice(tokens) for j in range(random.randrange(100, 1000))] for i in range(200)]
+    start = time.time()
+    for infoset in infosets:
+        infosetToTensor(infoset)
+    print('infosets per second', round(len(infosets) / (time.time() - start)))
+    start = time.time()
+    infosetsToTensors(infosets)
+    print('batched infosets per second', round(len(infosets) / (time.time() - start)))
@@ -1,11 +1,16 @@
 
+import asyncio
+import copy
+import io
 import time
 import torch.multiprocessing as mp
 import torch.distributed as dist
 import torch
 
 import config
+import inference
 import model
+import telemetry
 
 
 #runs the main process that controls the network
@@ -14,77 +19,130 @@ import model
 
 #is 'semaphore' the right word? who cares
 SEMAPHORE = 10
+
+#appended to each output sent through gloo, see inference.InferenceClient
+DONE = torch.ones(1)
+
+#receives message headers from every search process
+#the irecv isn't tied to a rank, so we only have to check one tensor instead of polling each rank
+#inputs have their own tag, so the next irecv can be posted before the last header's input comes in
 class Receiver:
-    def __init__(self, rank, defaultShape, defaultDType):
-        self.rank = rank
+    def __init__(self, defaultShape, defaultDType):
         self.tensor = None
         self.req = None
         self.defaultShape = defaultShape
         self.defaultDType = defaultDType
+        self.irecv()
 
-    def isReady(self, prefix=None):
-        if prefix is None:
-            return not (self.tensor is None or self.tensor[0].item() == SEMAPHORE)
-        else:
-            return self.tensor is not None and all([self.tensor[i].item() == v for i,v in enumerate(prefix)])
+    #whether a header has come in without blocking
+    #gloo doesn't mark the irecv as completed until we wait on it, hence the semaphore
+    def isReady(self):
+        return self.tensor[0].item() != SEMAPHORE
 
+    #blocks until a header comes in
+    #returns the rank that sent it and the header
     def get(self):
         self.req.wait()
-        return self.tensor
-
-    def irecv(self, shape=None, dtype=None):
-        if shape is None:
-            shape = self.defaultShape
-        if dtype is None:
-            dtype = self.defaultDType
-        self.tensor = torch.zeros(shape, dtype=dtype)
+        return self.req.source_rank(), self.tensor
+
+    def irecv(self):
+        self.tensor = torch.zeros(self.defaultShape, dtype=self.defaultDType)
         self.tensor[0] = SEMAPHORE
-        self.req = dist.irecv(self.tensor, src=self.rank)
+        self.req = dist.irecv(self.tensor)
 
-class MassReceiver:
-    def __init__(self, numProcesses, defaultShape, defaultDType):
-        self.receivers = []
-        self.removed = []
-        self.defaultShape = defaultShape
-        self.defaultDType = defaultDType
-        for i in range(1, numProcesses):
-            rec = Receiver(i, defaultShape, defaultDType)
-            rec.irecv(defaultShape)
-            self.receivers.append(rec)
-
-        self.recvIndex = 0
-
-    #gets next receiver that has a value
-    def getNextPending(self, prefix=None):
-        #check if any receivers are ready
-        for i in range(len(self.receivers)):
-            #start after last checked to avoid starvation
-            idx = (self.recvIndex + 1 + i) % len(self.receivers)
-            if self.receivers[idx].isReady(prefix):
-                self.recvIndex = idx
-                return self.receivers[idx]
+
+
+#saves the newly trained network for later evaluation
+#returns a task playing the test games, or None
+#the games run alongside the main loop, which keeps serving the search processes while they play
+def addTrainedModel(agent, player, playTestGames=None, numTestGames=0):
+    agent.oldModels[player].append(agent.advModels[player].net)
+    #assume we train once per iteration, so len should equal iteration number
+    agent.oldModelWeights[player].append(len(agent.oldModels[player]))
+
+    if len(agent.oldModels[0]) > 0 and len(agent.oldModels[1]) > 0 and playTestGames:
+        print('playing test games')
+        path = config.progressGamePath + 'progress' + str(len(agent.oldModels[player])) + '-' + config.gameName + '-' + str(round(time.time())) + '.txt'
+        #a network that finishes training during the games shouldn't change the players mid-game
+        snapshot = copy.copy(agent)
+        snapshot.oldModels = [list(nets) for nets in agent.oldModels]
+        snapshot.oldModelWeights = [list(weights) for weights in agent.oldModelWeights]
+        snapshot.ensembles = [None, None]
+        return asyncio.ensure_future(playProgressGames(snapshot, path, playTestGames, numTestGames))
+    else:
+        print('not playing test games')
         return None
 
-    #gets next receiver, regardless of status
-    #don't use this, it won't work if we have a pending irecv from an agent
-    def getNext(self):
-        self.recvIndex = (self.recvIndex + 1) % len(self.receivers)
-        return self.receivers[self.recvIndex]
+async def playProgressGames(agent, path, playTestGames, numTestGames):
+    with open(path, 'w') as f:
+        await playTestGames(agent, numTestGames, f)
 
-    #removes receiver from consideration
-    def remove(self, rank):
-        i, rec = next((i,rec) for i,rec in enumerate(self.receivers) if rec.rank == rank)
-        del self.receivers[i]
-        self.removed.append(rec)
+#runs in the training process
+#the weights go back and forth as bytes, so nothing depends on the other process staying alive
+def trainInBackground(name, softmax, writeLock, sharedDict, saveFile, weights, iteration, epochs, results):
+    trainer = model.DeepCfrModel(name=name, softmax=softmax, writeLock=writeLock, sharedDict=sharedDict, saveFile=saveFile)
+    #(if newIterNets is set, train() replaces the network anyway)
+    trainer.net.load_state_dict(torch.load(io.BytesIO(weights)))
+    trainer.train(iteration=iteration, epochs=epochs)
+    out = io.BytesIO()
+    torch.save(trainer.net.state_dict(), out)
+    results.put(out.getvalue())
 
-    #puts all receivers back into consideration
-    def restoreAll(self):
-        for rec in self.removed:
-            self.receivers.append(rec)
-        self.removed = []
-        
+#trains a copy of a player's advantage model in another process
+#so the net process can keep serving the current network to the search processes
+#training sets up amp and uses the gpu on its own, so it can't share a process with the forward passes
+class BackgroundTraining:
+    def __init__(self, agent, player):
+        self.player = player
+        served = agent.advModels[player]
+        weights = io.BytesIO()
+        torch.save(served.net.state_dict(), weights)
+        #cuda doesn't work in forked processes
+        context = mp.get_context('spawn')
+        self.results = context.Queue()
+        self.process = context.Process(target=trainInBackground, args=(served.name, served.softmax, served.writeLock, served.sharedDict, served.saveFile,
+                weights.getvalue(), len(agent.oldModels[player]), config.advEpochs, self.results))
+        self.process.start()
+        #the trained weights, once they come back
+        self.weights = None
 
+    def done(self):
+        if self.weights is None and not self.results.empty():
+            self.weights = self.results.get()
+        if self.weights is None and not self.process.is_alive():
+            raise RuntimeError('background training for player ' + str(self.player) + ' exited with code ' + str(self.process.exitcode))
+        return self.weights is not None
 
+    #blocks until training is done
+    def wait(self):
+        while not self.done():
+            time.sleep(0.1)
+        self.process.join()
+
+#swaps the trained network in for the served one
+#the served network isn't touched, so no request sees a half-trained network
+def finishTraining(agent, bt, playTestGames=None, numTestGames=0):
+    bt.wait()
+    net = copy.deepcopy(agent.advModels[bt.player].net)
+    net.load_state_dict(torch.load(io.BytesIO(bt.weights)))
+    agent.advModels[bt.player].net = net
+    return addTrainedModel(agent, bt.player, playTestGames, numTestGames)
+
+#waits for a header, shared memory requests, or a background training to finish
+#gloo can't wait on an irecv with a timeout (timing out closes the connections), so we check the header
+#sleeping for longer and longer while idle so we don't burn a core
+#returns (None, None) if there's something to do besides a header
+async def waitForWork(receiver, rings, training):
+    sleepTime = 0
+    while True:
+        if receiver.isReady():
+            return receiver.get()
+        if any(ring.hasRequests() for ring in rings) or any(bt and bt.done() for bt in training):
+            return None, None
+        #asyncio only sleeps in whole milliseconds, so yield to any other tasks and then sleep here
+        await asyncio.sleep(0)
+        time.sleep(sleepTime)
+        sleepTime = min(2 * sleepTime + 0.00001, 0.001)
 
 #send 0, X, X to stop
 #send 1, player, X to train net
@@ -92,82 +150,192 @@ class MassReceiver:
 #   follow with network input
 #   then recv the results
 #10 is reserved
-async def run(agent, numProcesses, playTestGames=None, numTestGames=0):
-    receiver = MassReceiver(numProcesses, 3, torch.long)
+#with the shared memory transport, evaluations go through the rings instead (see inference.ShmRing)
+async def run(agent, numProcesses, playTestGames=None, numTestGames=0, rings=[]):
+    receiver = Receiver(3, torch.long)
+    metrics = telemetry.ServerMetrics()
+    tracer = telemetry.Tracer(0, 'net')
+
+    #header that came in while batching but couldn't be batched
+    rank, msg = None, None
+
+    #BackgroundTraining for each player, if pipelineTraining is set
+    training = [None, None]
+    #how many times each player's network has been asked to train
+    #compared with len(agent.oldModels), this tells us how stale the network we're serving is
+    trainRequests = [len(agent.oldModels[0]), len(agent.oldModels[1])]
+    #tasks playing test games
+    testGameTasks = []
+
+    #holds on to the test games that adding a network might have started
+    def trained(task):
+        if task is not None:
+            testGameTasks.append(task)
 
     while True:
-        rec = receiver.getNextPending()
-        while not rec:
-            rec = receiver.getNextPending()
-            #rec = receiver.getNext()
-        #else:
-            #print('rec', rec.rank, rec.tensor)
-        msg = rec.get()
-        rank = rec.rank
+        #swap in any networks that finished training
+        for player, bt in enumerate(training):
+            if bt and bt.done():
+                trained(finishTraining(agent, bt, playTestGames, numTestGames))
+                training[player] = None
+        #result() raises if the games did
+        for task in [task for task in testGameTasks if task.done()]:
+            task.result()
+            testGameTasks.remove(task)
+        #the loop doesn't await while it's busy, so give the test games a turn
+        if testGameTasks:
+            await asyncio.sleep(0)
+
+        metrics.maybeWrite()
+
+        waitStart = time.time()
+        if msg is None:
+            rank, msg = await waitForWork(receiver, rings, training)
+        metrics.addTime('wait', time.time() - waitStart)
+        tracer.add('wait', waitStart, time.time())
 
         #print(rank, msg)
 
         #stop
-        if msg[0].item() == 0:
+        if msg is not None and msg[0].item() == 0:
+            for bt in training:
+                if bt:
+                    trained(finishTraining(agent, bt, playTestGames, numTestGames))
+            await asyncio.gather(*testGameTasks)
+            metrics.dump()
+            metrics.maybeWrite()
+            tracer.flush()
             break
 
         #train a new network
-        elif msg[0].item() == 1:
-            rec.irecv()
+        elif msg is not None and msg[0].item() == 1:
+            receiver.irecv()
             if rank != 1:
-                #receiver.remove(rank)
                 pass
             else:
                 player = msg[1].item()
+                #stats for the iteration that just ended
+                metrics.dump()
+                metrics.reset()
+                tracer.flush()
+                trainRequests[player] += 1
                 #train
                 agent.advModels[player].clearSampleCache()
-                agent.advModels[player].train(iteration=len(agent.oldModels[player]), epochs=config.advEpochs)
-                #save model for later evaluation
-                agent.oldModels[player].append(agent.advModels[player].net)
-                #assume we train once per iteration, so len should equal iteration number
-                agent.oldModelWeights[player].append(len(agent.oldModels[player]))
-
-                if len(agent.oldModels[0]) > 0 and len(agent.oldModels[1]) > 0 and playTestGames:
-                    print('playing test games')
-                    with open(config.progressGamePath + 'progress' + str(len(agent.oldModels[player])) + '-' + config.gameName + '-' + str(round(time.time())) + '.txt', 'w') as f:
-                        await playTestGames(agent, numTestGames, f)
+                if config.pipelineTraining:
+                    #can't have two versions of the same network training at once
+                    if training[player]:
+                        trained(finishTraining(agent, training[player], playTestGames, numTestGames))
+                    training[player] = BackgroundTraining(agent, player)
                 else:
-                    print('not playing test games')
+                    with tracer.span('train'):
+                        agent.advModels[player].train(iteration=len(agent.oldModels[player]), epochs=config.advEpochs)
+                        trained(addTrainedModel(agent, player, playTestGames, numTestGames))
 
                 #let agent know we're done
+                #or that we've started, if we're training in the background
                 out = torch.tensor([1], dtype=torch.long)
                 dist.isend(out, dst=rank)
+            msg = None
+
+        #a background training finished, which gets swapped in at the top of the loop
+        elif msg is None and not any(ring.hasRequests() for ring in rings):
+            continue
 
         #evaluate the network
-        elif msg[0].item() == 2:
-            inputs = []
-            ranks = []
-            #batch any pending network requests
-            nextRec = rec
-            while nextRec:
-                #print(nextRec.rank, 'next rec', msg)
-                #get metadata
-                player = msg[1].item()
-                inputSize = msg[2].item()
-                #get network input
-                netInput = torch.zeros((inputSize, 1 + model.NUM_TOKEN_BITS), dtype=torch.long)
-                dist.recv(netInput, src=nextRec.rank)
-                #print(nextRec.rank, 'got net input', netInput)
-                #save for evaluation
-                inputs.append(netInput)
-                ranks.append(nextRec.rank)
-
-                #print('sending irecv')
-                nextRec.irecv()
-                #print('getting next next rec')
-                nextRec = receiver.getNextPending([2, player])
-                if nextRec:
-                    #print('got next next rec')
-                    msg = nextRec.get()
+        #requests come from msg and/or the shared memory rings
+        else:
+            #(destination, input, time we got it) for each player's requests
+            #where destination is a rank for gloo or a (ring, slot) for shared memory
+            requests = [[], []]
+            #(player, index into requests) in the order requests came in
+            order = []
+            numRequests = 0
+            queueDepth = None
+            firstTime = time.time()
+            deadline = firstTime + config.maxWaitMicros / 1000000
+            sleepTime = 0
+            #irecvs for the gloo requests' inputs
+            inputRecvs = []
+            #collect requests until we have a full batch or we've waited long enough
+            #the first request already came in, so we're only waiting to fill out the batch
+            while True:
+                lastNumRequests = numRequests
+                if msg is not None:
+                    if msg[0].item() != 2:
+                        #handle it on the next loop
+                        break
+                    #print(rank, 'next rec', msg)
+                    #get metadata
+                    player = msg[1].item()
+                    inputSize = msg[2].item()
+                    #get network input
+                    #we wait on it right before the forward pass, so receiving it overlaps with collecting the batch
+                    netInput = torch.zeros((inputSize, 1 + model.NUM_TOKEN_BITS), dtype=torch.long)
+                    inputRecvs.append(dist.irecv(netInput, src=rank, tag=inference.INPUT_TAG))
+                    #print(rank, 'got net input', netInput)
+                    #save for evaluation
+                    order.append((player, len(requests[player])))
+                    requests[player].append((rank, netInput, time.time()))
+                    numRequests += 1
+
+                    #print('sending irecv')
+                    receiver.irecv()
+                    msg = None
 
+                for ring in rings:
+                    for slot, player, netInput in ring.claim(config.maxBatchSize - numRequests):
+                        order.append((player, len(requests[player])))
+                        requests[player].append(((ring, slot), netInput, time.time()))
+                        numRequests += 1
+
+                #everything we have on the first pass was already waiting for us
+                if queueDepth is None:
+                    queueDepth = numRequests
+
+                if numRequests >= config.maxBatchSize or time.time() >= deadline:
+                    break
+                if receiver.isReady():
+                    rank, msg = receiver.get()
+                elif numRequests == lastNumRequests:
+                    #nothing came in, so back off instead of spinning until the deadline
+                    time.sleep(max(min(sleepTime, deadline - time.time()), 0))
+                    sleepTime = 2 * sleepTime + 0.00001
+                else:
+                    sleepTime = 0
+
+            for recv in inputRecvs:
+                recv.wait()
+
+            forwardStart = time.time()
+            metrics.addTime('receive', forwardStart - firstTime)
+            tracer.add('receive', firstTime, forwardStart)
+            if numRequests == 0:
+                continue
+            metrics.addBatch(numRequests, forwardStart - firstTime, queueDepth)
+            for player in range(2):
+                metrics.addStaleness(player, trainRequests[player] - len(agent.oldModels[player]), len(requests[player]))
 
             #print('running through network')
-            outs = agent.advModels[player].batchPredict(inputs, convertToTensor=False).cpu()
-            for out, dst in zip(outs, ranks):
+            #one padded forward pass per player
+            outs = [None, None]
+            for player in range(2):
+                if requests[player]:
+                    inputs = [netInput for _, netInput, _ in requests[player]]
+                    outs[player] = agent.advModels[player].batchPredict(inputs, convertToTensor=False).cpu()
+            sendStart = time.time()
+            metrics.addTime('forward', sendStart - forwardStart)
+            tracer.add('forward', forwardStart, sendStart)
+            #search processes expect their outputs in the order they sent the requests
+            for player, i in order:
+                dst, _, startTime = requests[player][i]
                 #print('sending eval to', dst)
-                dist.send(out, dst=dst)
+                if type(dst) == tuple:
+                    ring, slot = dst
+                    ring.respond(slot, outs[player][i])
+                    metrics.addRequest(ring.rank, time.time() - startTime)
+                else:
+                    #the 1 on the end tells the search process the output has come in
+                    dist.send(torch.cat((outs[player][i], DONE)), dst=dst)
+                    metrics.addRequest(dst, time.time() - startTime)
+            metrics.addTime('send', time.time() - sendStart)
+            tracer.add('send', sendStart, time.time())
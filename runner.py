@@ -12,14 +12,18 @@ import os
 import random
 import sys
 import subprocess
+import torch
 import torch.multiprocessing as mp
 import torch.distributed as dist 
 
 import config
+import contextPool
 import dataStorage
 import deepcfr
+import inference
 import model
 import nethandler
+import scheduler
 
 
 #This file has functions relating to running the AI
@@ -41,6 +45,8 @@ async def trainAndPlay(numProcesses, pid, saveFile=None, clear=False, file=sys.s
 
     oldModels = [[], []]
     oldModelWeights = [[], []]
+    #iterations of the saved strategy networks for each player
+    stratIters = [[], []]
     if pid == 0 and saveFile:
         if os.path.isdir(saveFile):
             for filename in os.listdir(saveFile):
@@ -55,6 +61,10 @@ async def trainAndPlay(numProcesses, pid, saveFile=None, clear=False, file=sys.s
                     player = 0
                 elif parts[-3] == 'adv1':
                     player = 1
+                elif parts[-3] in ['strat0', 'strat1']:
+                    #distilled strategy networks, which are loaded after the agent is set up
+                    stratIters[int(parts[-3][-1])].append(int(parts[-2]))
+                    continue
                 else:
                     continue
                 #iteration
@@ -67,6 +77,8 @@ async def trainAndPlay(numProcesses, pid, saveFile=None, clear=False, file=sys.s
             os.mkdir(saveFile)
 
     stratModels = []
+    if pid == 0 and (config.distillGames or config.playDistilled):
+        stratModels = [model.DeepCfrModel(name='strat' + str(i), softmax=True, writeLock=writeLock, sharedDict=sharedDict, useNet=True, saveFile=saveFile) for i in range(2)]
     #right now agents don't directly use the model for evaluation, but the use it to write samples
     #TODO separate out the sample-writing so we can get rid of this 'useNet' business
     advModels = [model.DeepCfrModel(name='adv' + str(i), softmax=False, writeLock=writeLock, sharedDict=sharedDict, useNet=(pid == 0), saveFile=saveFile) for i in range(2)]
@@ -108,16 +120,30 @@ async def trainAndPlay(numProcesses, pid, saveFile=None, clear=False, file=sys.s
             print('setting up net process', file=sys.stderr)
             if clear or saveFile is None:
                 dataStorage.clearData()
+            #search processes open their rings after the barrier, so they have to exist by then
+            if config.inferenceTransport == 'shm':
+                rings = [inference.ShmRing(rank, create=True) for rank in range(1, numProcesses)]
+            else:
+                rings = []
+            #search processes connect to this after the barrier too
+            traversalScheduler = scheduler.TraversalScheduler(isMaster=True) if config.workStealing else None
             dist.barrier()
             agent.oldModels = oldModels
             agent.oldModelWeights = oldModelWeights
-            await nethandler.run(agent, numProcesses, testGames, config.progressGamesToRecord)
+            try:
+                await nethandler.run(agent, numProcesses, testGames, config.progressGamesToRecord, rings=rings)
+            finally:
+                for ring in rings:
+                    ring.unlink()
         else:
             print('setting up search process', pid, file=sys.stderr)
             dist.barrier()
-            async with config.game.getContext() as context:
+            traversalScheduler = scheduler.TraversalScheduler() if config.workStealing else None
+            async with config.game.getContext() as context, contextPool.ContextPool(config.contextPoolSize) as pool:
                 await agent.search(
                     context=context,
+                    contextPool=pool,
+                    scheduler=traversalScheduler,
                     pid=pid-1,
                     limit=config.limit,
                     innerLoops=config.innerLoops,
@@ -138,8 +164,76 @@ async def trainAndPlay(numProcesses, pid, saveFile=None, clear=False, file=sys.s
 
     print('pid 0 continuing')
 
+    if config.distillGames:
+        await distill(agent, config.distillGames)
+    elif config.playDistilled:
+        if not all(stratIters):
+            print('error playDistilled is set, but there are no strategy networks to load', file=sys.stderr)
+            quit()
+        for i in range(2):
+            stratModels[i].loadModel(max(stratIters[i]))
+    agent.playStratModels = config.playDistilled
+
     await testGames(agent, config.numTestGames, file)
 
+#distills the old models into one strategy network per player
+#so playing takes one forward pass per move, instead of a pass for every old model
+#the infosets come from self-play with the old models, labeled with their strategy and expected value
+#some infosets are held out to report how far the strategy networks are from the old models
+async def distill(agent, num):
+    history = config.GameConfig.history
+    #(infoset, probs, expected value) for each player
+    heldOut = [[], []]
+    with open(os.devnull, 'w') as devnull:
+        for stratModel in agent.stratModels:
+            dataStorage.clearSamplesByName(stratModel.name)
+
+        async with config.game.getContext() as context:
+            async def play(game):
+                reachTrackers = [deepcfr.ReachTracker(), deepcfr.ReachTracker()]
+                while True:
+                    player, req, actions = await game.getTurn()
+                    if 'win' in req:
+                        return
+                    infoset = game.getInfoset(player)
+                    probs, expVal = agent.getStrategy(player, infoset, actions, game.prevTrajectories[player], file=devnull, reachTracker=reachTrackers[player])
+                    if random.random() < config.distillValSplit:
+                        heldOut[player].append((infoset, probs, expVal))
+                    else:
+                        agent.stratModels[player].addSample(infoset, probs, 1, expVal)
+                    await game.takeAction(player, np.random.choice(len(actions), p=probs))
+
+            for i in range(num):
+                seed = config.game.getSeed()
+                game = config.game.Game(context=context, seed=seed, history=history, saveTrajectories=True, file=devnull)
+                await game.startGame()
+                gameTask = asyncio.ensure_future(play(game))
+                await game.winner
+                gameTask.cancel()
+
+    agent.stratTrain()
+
+    for player in range(2):
+        if not heldOut[player]:
+            continue
+        with torch.no_grad():
+            outs = agent.stratModels[player].batchPredict([infoset for infoset, probs, expVal in heldOut[player]]).float().cpu().numpy()
+        distances = []
+        divergences = []
+        valueErrors = []
+        for out, (infoset, probs, expVal) in zip(outs, heldOut[player]):
+            #the strategy network gives a probability for every action, so only compare the legal ones
+            stratProbs = np.maximum(out[0:len(probs)], 0)
+            stratSum = np.sum(stratProbs)
+            stratProbs = stratProbs / stratSum if stratSum > 0 else np.full(len(probs), 1 / len(probs))
+            distances.append(0.5 * np.sum(np.abs(probs - stratProbs)))
+            divergences.append(np.sum(probs * np.log(np.maximum(probs, 1e-6) / np.maximum(stratProbs, 1e-6))))
+            valueErrors.append(abs(out[-1] - expVal))
+        print('player', player, 'distillation divergence on', len(distances), 'held out infosets',
+                'total variation mean', np.mean(distances), 'max', np.max(distances),
+                'kl mean', np.mean(divergences),
+                'value error mean', np.mean(valueErrors), file=sys.stderr)
+
 async def testGames(agent, num, file=sys.stdout):
     history = config.GameConfig.history
     async with config.game.getContext() as context:
@@ -147,6 +241,8 @@ async def testGames(agent, num, file=sys.stdout):
         #which due to concurrency issues might not be until we get into the MCTS loop
         async def play(game):
             i = 0
+            #reach probabilities of each player's trajectory so far, so each turn only evaluates the newest step
+            reachTrackers = [deepcfr.ReachTracker(), deepcfr.ReachTracker()]
             #actions taken so far by in the actual game
             while True:
                 i += 1
@@ -156,7 +252,7 @@ async def testGames(agent, num, file=sys.stdout):
                     player, req, actions = await game.getTurn()
                     infoset = game.getInfoset(player)
 
-                    probs = agent.getProbs(player, infoset, actions, game.prevTrajectories[player], file=file)
+                    probs = agent.getProbs(player, infoset, actions, game.prevTrajectories[player], file=file, reachTracker=reachTrackers[player])
 
                     #remove low probability moves, likely just noise
                     normProbs = np.array([p if p > config.probCutoff else 0 for p in probs])
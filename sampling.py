@@ -0,0 +1,120 @@
+import numpy as np
+
+import config
+
+#policies for which on player actions cfrRecur expands
+#these are only used at nodes that aren't being rolled out, rollouts always sample one action from the strategy
+
+#select takes the regret matched strategy and the predicted advantages for the node's actions
+#and returns (indices of actions to expand, odds each action was sampled, indices of pruned actions)
+#actions that aren't expanded or pruned are probed if enableProbingRollout is set, and get 0 reward if not
+#pruned actions aren't played at all, they keep their predicted advantage as their label
+#deterministic is whether select always picks the same actions for the same network outputs
+#which cfrRecur's transposition table needs
+#weighted is whether the odds are each action's odds of being expanded at all
+#then, without probing, cfrRecur divides expanded actions' values by their odds, like outcome sampling
+
+#the original sampling
+#takes branchingLimit actions from the strategy mixed with onExploreRate of uniform random
+#or every action if branchingLimit is None
+class BranchingPolicy:
+    name = 'branching'
+    #exploreProbs are the odds of each draw, not of the action being in the sample
+    weighted = False
+
+    @property
+    def deterministic(self):
+        return not config.branchingLimit
+
+    def select(self, probs, regrets, numActions):
+        if config.branchingLimit:
+            #select a set of actions to pick
+            #chance to play randomly instead of picking the best actions
+            #this paper suggests playing according the currect strategy with some exploration factor for outcome
+            #sampling (i.e. branchLimit = 1), so I assume that that's a good method for other branch limits
+            #http://mlanctot.info/files/papers/nips09mccfr.pdf
+            #the double neural CFR paper suggests using uniform random distribution, which is probably fine too
+            exploreProbs = probs * (1 - config.onExploreRate) + config.onExploreRate / len(probs)
+            actionIndices = np.random.choice(numActions, min(numActions, config.branchingLimit),
+                    replace=False, p=exploreProbs)
+            #this is only true for branchingLimit=1, but I don't feel like coding a general solution right now
+            return actionIndices, exploreProbs, []
+        else:
+            return FullWidthPolicy().select(probs, regrets, numActions)
+
+#every action, i.e. external sampling
+class FullWidthPolicy:
+    name = 'fullWidth'
+    deterministic = True
+    weighted = False
+
+    def select(self, probs, regrets, numActions):
+        #100% chance of sampling each action
+        return list(range(numActions)), np.ones(numActions), []
+
+#full width, except for actions with a predicted advantage below pruneThreshold
+#the advantage network estimates cumulative regret, so a strongly negative advantage means the action has stayed bad
+#regret matching gives those actions 0 probability anyway, so they don't change the state's value
+#this is regret-based pruning (Brown and Sandholm) using the network's regrets instead of tabular ones
+#a pruned action's label is the network's own prediction, so its regret could never go back up
+#so each one is expanded anyway with odds pruneReexpandRate, and gets trained on its real value then
+#like Pluribus, which skips negative regret actions 95% of the time instead of always
+class RegretPruningPolicy:
+    name = 'pruning'
+    #the value of a re-expanded action doesn't count towards the state's value, so there's nothing to weight
+    weighted = False
+
+    @property
+    def deterministic(self):
+        return not config.pruneReexpandRate
+
+    def select(self, probs, regrets, numActions):
+        regrets = regrets[0:numActions]
+        #always keep the best action, regret matching plays it when nothing is positive
+        best = np.argmax(regrets)
+        sampleProbs = np.ones(numActions)
+        pruned = []
+        for i in range(numActions):
+            if regrets[i] < config.pruneThreshold and i != best:
+                sampleProbs[i] = config.pruneReexpandRate
+                if np.random.random() >= config.pruneReexpandRate:
+                    pruned.append(i)
+        actionIndices = [i for i in range(numActions) if i not in pruned]
+        return actionIndices, sampleProbs, pruned
+
+#samples robustSampleSize actions uniformly without replacement
+#from the double neural cfr paper
+#the sample odds don't depend on the strategy, so bad early networks can't starve actions
+class RobustPolicy:
+    name = 'robust'
+    deterministic = False
+    weighted = True
+
+    def select(self, probs, regrets, numActions):
+        k = min(numActions, config.robustSampleSize)
+        actionIndices = np.random.choice(numActions, k, replace=False)
+        return actionIndices, np.full(numActions, k / numActions), []
+
+#average strategy sampling, like the AVERAGE mode in old/montecarlo/cfr.py
+#from Efficient Monte Carlo Counterfactual Regret Minimization in Games with Many Player Actions (Gibson et al.)
+#each action is sampled independently with odds max(epsilon, (bonus + threshold * s) / (bonus + sum(s)))
+#we don't track the average strategy during search, so like the old code this uses the current strategy for s
+#threshold means any action with s > 1 / threshold is always taken, bonus boosts every action early on
+#s sums to 1 here, so threshold = 1 and bonus = 0 would just sample from the current strategy
+class AverageStrategyPolicy:
+    name = 'average'
+    deterministic = False
+    weighted = True
+
+    def select(self, probs, regrets, numActions):
+        sampleProbs = (config.averageBonus + config.averageThreshold * probs) / (config.averageBonus + np.sum(probs))
+        sampleProbs = np.clip(sampleProbs, config.averageEpsilon, 1)
+        #it's fine if nothing gets sampled, the weighted values are still right on average
+        actionIndices = [i for i in range(numActions) if np.random.random() < sampleProbs[i]]
+        return actionIndices, sampleProbs, []
+
+policies = {policy.name: policy for policy in [BranchingPolicy, FullWidthPolicy, RegretPruningPolicy, RobustPolicy, AverageStrategyPolicy]}
+
+#the policy named by config.samplingPolicy
+def getPolicy(name=None):
+    return policies[name if name else config.samplingPolicy]()
@@ -0,0 +1,28 @@
+import datetime
+import os
+import torch.distributed as dist
+
+import config
+
+#hands out traversals to the search processes from a shared counter
+#pokemon traversals vary a lot in length, so with a fixed number of traversals per process
+#the slowest process sets the pace and the others sit at the barrier
+#instead, each process takes the next traversal number until the iteration's quota is used up
+
+#the counter lives in a TCPStore hosted by the net process
+class TraversalScheduler:
+    def __init__(self, isMaster=False):
+        #the net process starts the store before the barrier, and add() doesn't wait on anything else
+        #so if a call takes this long, the net process is gone, and raising beats hanging the search processes forever
+        self.store = dist.TCPStore(os.environ['MASTER_ADDR'], config.schedulerPort, is_master=isMaster,
+                timeout=datetime.timedelta(minutes=5), wait_for_workers=False)
+
+    #yields traversal numbers for the iteration until quota traversals have been handed out across all processes
+    #the counter is only touched between traversals, so concurrent traversal runners can share this
+    def traversals(self, iteration, quota):
+        while True:
+            #add is atomic, so every traversal number goes to exactly one process
+            ticket = self.store.add('traversals' + str(iteration), 1) - 1
+            if ticket >= quota:
+                return
+            yield ticket
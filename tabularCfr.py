@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import sys
+import time
+
+#tabular cfr for warPoker (games/warPoker.py), as a reference for the deep cfr agent
+#the whole game tree is a few betting histories, so every deal gets updated at once with numpy
+#supports vanilla cfr, cfr+, and discounted cfr
+
+#everything is in terms of roles instead of players
+#role 0 acts first, which is the player who isn't the dealer, and role 1 is the dealer
+#values are for role 0, normalized the same way as warPoker's
+#warPoker picks the dealer at random, so each player is each role half the time
+
+#cards are 2 through 14, index 0 is the 2
+NUM_CARDS = 13
+
+#decision nodes, history => (role, actions)
+#histories use c for call (or check), r for raise, f for fold
+#actions are in the same order as _Game.actionDict, so the indices match the game's action indices
+NODES = {
+    '': (0, 'cr'),
+    'c': (1, 'cr'),
+    'r': (1, 'fc'),
+    'cr': (0, 'fc'),
+}
+
+#terminal histories => (whether it goes to showdown, payoff to role 0)
+#a showdown pays the winner the loser's pot
+TERMINALS = {
+    'cc': (True, 0.5),
+    'crf': (False, -0.5),
+    'crc': (True, 1),
+    'rf': (False, 0.5),
+    'rc': (True, 1),
+}
+
+ACTION_NAMES = {'c': 'call', 'r': 'raise', 'f': 'fold'}
+
+#discounted cfr parameters, from Solving Imperfect-Information Games via Discounted Regret Minimization
+#positive regrets are scaled by t^alpha / (t^alpha + 1), negative by t^beta / (t^beta + 1)
+#and the average strategy by (t / (t + 1))^gamma
+DCFR_ALPHA = 1.5
+DCFR_BETA = 0
+DCFR_GAMMA = 2
+
+#payoff matrix for each terminal, indexed by [role 0 card, role 1 card]
+#weighted by the odds of the deal, so a matrix-vector product with a reach vector gives counterfactual values
+def _getPayoffs():
+    deals = (1 - np.eye(NUM_CARDS)) / (NUM_CARDS * (NUM_CARDS - 1))
+    showdown = np.sign(np.arange(NUM_CARDS)[:, None] - np.arange(NUM_CARDS)[None, :])
+    payoffs = {}
+    for history, (isShowdown, payoff) in TERMINALS.items():
+        payoffs[history] = deals * payoff * (showdown if isShowdown else 1)
+    return payoffs
+
+PAYOFFS = _getPayoffs()
+
+#a strategy is history => (NUM_CARDS, 2) array of action probabilities for each card
+
+def getUniformStrategy():
+    return {history: np.full((NUM_CARDS, 2), 0.5) for history in NODES}
+
+#strategy with probabilities proportional to the positive part of each row
+#rows with nothing positive are played uniformly
+def normalize(weights):
+    positive = np.maximum(weights, 0)
+    total = np.sum(positive, axis=1, keepdims=True)
+    return np.where(total > 0, positive / np.where(total > 0, total, 1), 0.5)
+
+#counterfactual values for player at each card, given the reach probabilities of each role at each card
+#with bestResponse, player picks their best action for each card instead of following strategy
+#with solver, player's regrets and strategy sums are updated
+def _walk(history, reaches, strategy, player, bestResponse=False, solver=None):
+    if history in PAYOFFS:
+        payoffs = PAYOFFS[history]
+        if player == 0:
+            return payoffs @ reaches[1]
+        else:
+            return -1 * (payoffs.T @ reaches[0])
+
+    role, actions = NODES[history]
+    probs = strategy[history]
+    childValues = []
+    for i, action in enumerate(actions):
+        childReaches = list(reaches)
+        #a best responder's reach doesn't affect their own counterfactual values
+        if role != player or not bestResponse:
+            childReaches[role] = reaches[role] * probs[:, i]
+        childValues.append(_walk(history + action, childReaches, strategy, player, bestResponse, solver))
+    childValues = np.stack(childValues, axis=1)
+
+    if role != player:
+        #the opponent's probabilities are already in the reach
+        return np.sum(childValues, axis=1)
+    if bestResponse:
+        return np.max(childValues, axis=1)
+    values = np.sum(probs * childValues, axis=1)
+    if solver:
+        solver.update(history, childValues - values[:, None], reaches[role][:, None] * probs)
+    return values
+
+#expected value for each role when both follow strategy
+def getValues(strategy):
+    ones = np.ones(NUM_CARDS)
+    return [np.sum(_walk('', [ones, ones], strategy, player)) for player in range(2)]
+
+#how much each role could win by best responding to the other role's part of the strategy
+def getBestResponseValues(strategy):
+    ones = np.ones(NUM_CARDS)
+    return [np.sum(_walk('', [ones, ones], strategy, player, bestResponse=True)) for player in range(2)]
+
+#average of what a best response wins against each role, 0 at a nash equilibrium
+#for a player of the actual game, this is also the average over which one is the dealer
+def getExploitability(strategy):
+    return sum(getBestResponseValues(strategy)) / 2
+
+class Solver:
+    #mode is 'cfr', 'cfr+', or 'dcfr'
+    def __init__(self, mode='cfr+'):
+        self.mode = mode
+        self.regrets = {history: np.zeros((NUM_CARDS, 2)) for history in NODES}
+        self.strategySums = {history: np.zeros((NUM_CARDS, 2)) for history in NODES}
+        self.iteration = 0
+
+    #regret matched strategy for the current iteration
+    def getStrategy(self):
+        return {history: normalize(regrets) for history, regrets in self.regrets.items()}
+
+    #the average strategy is what converges to a nash equilibrium
+    def getAverageStrategy(self):
+        return {history: normalize(strategySum) for history, strategySum in self.strategySums.items()}
+
+    #called by _walk for each of the updating player's nodes
+    #regrets are the instantaneous counterfactual regrets, contributions are reach * strategy
+    def update(self, history, regrets, contributions):
+        t = self.iteration
+        if self.mode == 'cfr':
+            self.regrets[history] += regrets
+            self.strategySums[history] += contributions
+        elif self.mode == 'cfr+':
+            self.regrets[history] = np.maximum(self.regrets[history] + regrets, 0)
+            #linear averaging
+            self.strategySums[history] += t * contributions
+        elif self.mode == 'dcfr':
+            total = self.regrets[history] + regrets
+            positiveScale = t ** DCFR_ALPHA / (t ** DCFR_ALPHA + 1)
+            negativeScale = t ** DCFR_BETA / (t ** DCFR_BETA + 1)
+            self.regrets[history] = np.where(total > 0, total * positiveScale, total * negativeScale)
+            self.strategySums[history] = (self.strategySums[history] + contributions) * (t / (t + 1)) ** DCFR_GAMMA
+
+    #one iteration with alternating updates, so role 1 responds to role 0's new regrets
+    def iterate(self):
+        self.iteration += 1
+        ones = np.ones(NUM_CARDS)
+        for player in range(2):
+            _walk('', [ones, ones], self.getStrategy(), player, solver=self)
+
+    #returns a list of (iteration, exploitability of the average strategy, seconds so far)
+    def solve(self, iterations, reportInterval=None):
+        start = time.time()
+        reports = []
+        for i in range(iterations):
+            self.iterate()
+            if reportInterval and self.iteration % reportInterval == 0:
+                reports.append((self.iteration, getExploitability(self.getAverageStrategy()), time.time() - start))
+        return reports
+
+#comparing against warPoker games, like the deep cfr agent's
+
+#the history's actions, as (role, action name)
+def _getActions(history):
+    actions = []
+    for i, action in enumerate(history):
+        #roles alternate, starting with role 0
+        actions.append((i % 2, ACTION_NAMES[action]))
+    return actions
+
+#the infoset warPoker gives the acting role at a decision node, with the options
+def getInfoset(card, history):
+    role, actions = NODES[history]
+    #the dealer's deal action is the first thing after the hand
+    infoset = ['start', 'hand', str(card + 2), '0' if role == 1 else '1', 'deal']
+    for actor, action in _getActions(history):
+        #infosets are in first person
+        infoset += ['0' if actor == role else '1', action]
+    infoset.append('OPTIONS')
+    for i, action in enumerate(actions):
+        infoset += ['@' + str(i), ACTION_NAMES[action]]
+    return infoset
+
+def getActions(history):
+    role, actions = NODES[history]
+    return [[ACTION_NAMES[action]] for action in actions]
+
+#the (infoset, action index, actions) trajectory the acting role took to get to history
+#in the same form as the game's prevTrajectories
+def getTrajectory(card, history):
+    role, actions = NODES[history]
+    trajectory = []
+    if role == 1:
+        #the dealer deals before anything else
+        trajectory.append((['start', 'hand', str(card + 2), 'OPTIONS', '@0', 'deal'], 0, [['deal']]))
+    for i in range(len(history)):
+        if NODES[history[:i]][0] == role:
+            prevActions = NODES[history[:i]][1]
+            trajectory.append((getInfoset(card, history[:i]), prevActions.index(history[i]), getActions(history[:i])))
+    return trajectory
+
+#builds a strategy by asking policy for the probabilities at each infoset
+#policy is called like policy(role, infoset, actions, prevTrajectory)
+#for the deep cfr agent, that's something like lambda role, *args: agent.getProbs(player, *args)
+#which gives the strategy one player would use in both roles
+def getPolicyStrategy(policy):
+    strategy = {}
+    for history, (role, actions) in NODES.items():
+        probs = np.zeros((NUM_CARDS, 2))
+        for card in range(NUM_CARDS):
+            probs[card] = policy(role, getInfoset(card, history), getActions(history), getTrajectory(card, history))
+        strategy[history] = probs
+    return strategy
+
+def printStrategy(strategy, file=sys.stdout):
+    for history, (role, actions) in NODES.items():
+        names = '/'.join(ACTION_NAMES[action] for action in actions)
+        print('role', role, 'history', repr(history), names, file=file)
+        for card in range(NUM_CARDS):
+            print('    card', card + 2, np.round(strategy[history][card], 3), file=file)
+
+if __name__ == '__main__':
+    #convergence of each mode, then the strategy and values from the best one
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    solvers = {}
+    for mode in ['cfr', 'cfr+', 'dcfr']:
+        solver = Solver(mode)
+        reports = solver.solve(iterations, reportInterval=iterations // 10)
+        solvers[mode] = solver
+        for iteration, exploitability, seconds in reports:
+            print(mode, 'iteration', iteration, 'exploitability', '%.3g' % exploitability, 'seconds', round(seconds, 3))
+
+    mode, solver = min(solvers.items(), key=lambda item: getExploitability(item[1].getAverageStrategy()))
+    strategy = solver.getAverageStrategy()
+    print()
+    print('average strategy from', mode)
+    printStrategy(strategy)
+    print('role 0 (non-dealer) value', getValues(strategy)[0])
+    print('uniform random exploitability', getExploitability(getUniformStrategy()))
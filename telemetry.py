@@ -0,0 +1,191 @@
+import collections
+import contextvars
+import json
+import numpy as np
+import os
+import sys
+import time
+
+import config
+
+#metrics for the net process
+#these get printed every iteration and written to config.telemetryPath every config.telemetryInterval seconds
+#so we can size numProcesses and the batching knobs from data
+
+#how many latencies we keep for each rank's percentiles
+LATENCY_WINDOW = 10000
+
+class ServerMetrics:
+    def __init__(self, path=None, interval=None):
+        self.path = path if path is not None else config.telemetryPath
+        self.interval = interval if interval is not None else config.telemetryInterval
+        self.startTime = time.time()
+        self.lastWrite = self.startTime
+        self.reset()
+
+    #clears everything except the start time
+    def reset(self):
+        #rank => number of requests
+        self.requests = collections.Counter()
+        #batch size => count
+        self.sizes = collections.Counter()
+        #how long we waited to fill each batch, bucketed by powers of 2 microseconds
+        self.waits = collections.Counter()
+        #number of requests that were already waiting when we started collecting a batch
+        self.queueDepths = collections.Counter()
+        #(player, staleness) => number of requests
+        #staleness is how many trainings the served network is behind
+        self.staleness = collections.Counter()
+        #rank => recent times between picking up a request and sending its output
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_WINDOW))
+        #seconds spent in each part of the loop
+        self.phases = collections.Counter()
+
+    def addBatch(self, size, waitTime, queueDepth):
+        self.sizes[size] += 1
+        self.waits[1 << int(waitTime * 1000000).bit_length()] += 1
+        self.queueDepths[queueDepth] += 1
+
+    def addStaleness(self, player, staleness, count):
+        if count:
+            self.staleness[(player, staleness)] += count
+
+    def addRequest(self, rank, latency):
+        self.requests[rank] += 1
+        self.latencies[rank].append(latency)
+
+    #phase is 'wait', 'receive', 'forward', or 'send'
+    def addTime(self, phase, seconds):
+        self.phases[phase] += seconds
+
+    def getSummary(self):
+        numBatches = sum(self.sizes.values())
+        numRequests = sum(self.requests.values())
+        latencies = {}
+        for rank, l in self.latencies.items():
+            if l:
+                p50, p95, p99 = np.percentile(l, [50, 95, 99])
+                latencies[rank] = {'p50': p50, 'p95': p95, 'p99': p99}
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self.startTime,
+            'requests': numRequests,
+            'requestsPerRank': dict(self.requests),
+            'batches': numBatches,
+            'meanBatchSize': numRequests / numBatches if numBatches else 0,
+            'batchSizes': sorted(self.sizes.items()),
+            'batchWaitMicros': sorted(self.waits.items()),
+            'queueDepths': sorted(self.queueDepths.items()),
+            'staleness': [[player, staleness, count] for (player, staleness), count in sorted(self.staleness.items())],
+            'latencySecondsPerRank': latencies,
+            'phaseSeconds': dict(self.phases),
+        }
+
+    #human readable version for the log
+    def dump(self, file=sys.stderr):
+        summary = self.getSummary()
+        if summary['batches'] == 0:
+            return
+        print('batches', summary['batches'], 'requests', summary['requests'], 'mean batch size', summary['meanBatchSize'], file=file)
+        print('batch size histogram', summary['batchSizes'], file=file)
+        print('batch wait histogram (< micros, count)', summary['batchWaitMicros'], file=file)
+        print('queue depth histogram', summary['queueDepths'], file=file)
+        print('model staleness histogram (player, staleness, count)', summary['staleness'], file=file)
+        for rank, l in sorted(summary['latencySecondsPerRank'].items()):
+            print('rank', rank, 'latency ms p50', round(l['p50'] * 1000, 3), 'p95', round(l['p95'] * 1000, 3), 'p99', round(l['p99'] * 1000, 3), file=file)
+        print('seconds spent', {phase: round(t, 3) for phase, t in summary['phaseSeconds'].items()}, file=file)
+
+    #writes the summary out if it's been long enough since the last write
+    def maybeWrite(self):
+        if not self.path or time.time() - self.lastWrite < self.interval:
+            return
+        self.lastWrite = time.time()
+        #write then rename, so anything reading the file never sees half of it
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'w') as file:
+            json.dump(self.getSummary(), file)
+        os.replace(tmpPath, self.path)
+
+#chrome trace of where a process spends its time
+#load the files in chrome://tracing or ui.perfetto.dev
+#each rank writes its own file, mergeTraces combines them so the net and search processes line up
+#timestamps are wall clock, so files from processes on the same machine line up too
+
+#concurrent traversals interleave their spans, which the trace viewers can't draw on one row
+#so each traversal runner sets its own track (contextvars are copied into each asyncio task)
+traceTrack = contextvars.ContextVar('traceTrack', default=0)
+
+#number of events a tracer holds before writing them out
+TRACE_BUFFER_SIZE = 10000
+
+class _Span:
+    __slots__ = ['tracer', 'name', 'start']
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *args):
+        self.tracer.add(self.name, self.start, time.time())
+
+class Tracer:
+    #without a rank, we only keep the per-phase totals
+    def __init__(self, rank=None, name=None, path=None):
+        path = path if path is not None else config.tracePath
+        self.rank = rank
+        self.path = path + '.' + str(rank) + '.json' if path and rank is not None else None
+        #seconds spent in each phase since the last dumpTotals
+        #spans from concurrent traversals overlap, so these can add up to more than the wall time
+        self.totals = collections.Counter()
+        self.events = []
+        if self.path:
+            with open(self.path, 'w') as file:
+                #the closing bracket is optional in the trace format, which lets us keep appending
+                print('[', file=file)
+            self.events.append({'name': 'process_name', 'ph': 'M', 'pid': rank, 'args': {'name': name if name else 'rank ' + str(rank)}})
+
+    #with tracer.span('name'):
+    def span(self, name):
+        return _Span(self, name)
+
+    #records a span that has already happened
+    def add(self, name, start, end):
+        self.totals[name] += end - start
+        if self.path:
+            self.events.append({'name': name, 'ph': 'X', 'pid': self.rank, 'tid': traceTrack.get(), 'ts': start * 1000000, 'dur': (end - start) * 1000000})
+            #the net process records a few events per batch, so don't hold a whole iteration's worth
+            if len(self.events) >= TRACE_BUFFER_SIZE:
+                self.flush()
+
+    #appends the recorded events to the trace file
+    def flush(self):
+        if not self.path or not self.events:
+            return
+        with open(self.path, 'a') as file:
+            for event in self.events:
+                print(json.dumps(event) + ',', file=file)
+        self.events = []
+
+    def dumpTotals(self, file=sys.stderr):
+        if self.totals:
+            print('rank', self.rank, 'seconds spent', {name: round(t, 3) for name, t in sorted(self.totals.items())}, file=file)
+        self.totals = collections.Counter()
+
+#combines the per rank trace files into one trace
+def mergeTraces(paths, outPath):
+    events = []
+    for path in paths:
+        with open(path) as file:
+            for line in file:
+                line = line.strip().rstrip(',')
+                if line and line not in ['[', ']']:
+                    events.append(json.loads(line))
+    with open(outPath, 'w') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+if __name__ == '__main__':
+    #python telemetry.py merged.json trace.0.json trace.1.json ...
+    mergeTraces(sys.argv[2:], sys.argv[1])
@@ -0,0 +1,7 @@
+import os
+import sys
+
+#the tests import the top level modules, and config loads the pokemon data relative to the working directory
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+os.chdir(root)
@@ -0,0 +1,100 @@
+import collections
+import itertools
+import numpy as np
+import random
+
+import games.holdem as holdem
+
+#games/holdem.py's table evaluator against a brute force one
+
+#comparable (category, tiebreak ranks) for 5 cards
+def scoreFive(cards):
+    ranks = sorted((c >> 2 for c in cards), reverse=True)
+    isFlush = len(set(c & 3 for c in cards)) == 1
+    #ranks grouped by count, bigger groups then higher ranks first
+    counts = collections.Counter(ranks)
+    groups = sorted(counts.items(), key=lambda item: (item[1], item[0]), reverse=True)
+    shape = [count for rank, count in groups]
+    tiebreak = [rank for rank, count in groups]
+    straight = None
+    if len(counts) == 5:
+        if ranks[0] - ranks[4] == 4:
+            straight = ranks[0]
+        elif ranks == [12, 3, 2, 1, 0]:
+            #the wheel is 5 high
+            straight = 3
+    if straight is not None and isFlush:
+        return (8, straight)
+    if shape == [4, 1]:
+        return (7, *tiebreak)
+    if shape == [3, 2]:
+        return (6, *tiebreak)
+    if isFlush:
+        return (5, *tiebreak)
+    if straight is not None:
+        return (4, straight)
+    if shape == [3, 1, 1]:
+        return (3, *tiebreak)
+    if shape == [2, 2, 1]:
+        return (2, *tiebreak)
+    if shape == [2, 1, 1, 1]:
+        return (1, *tiebreak)
+    return (0, *tiebreak)
+
+def bruteForce(cards):
+    return max(scoreFive(five) for five in itertools.combinations(cards, 5))
+
+def parse(hand):
+    return [holdem.CARD_NAMES.index(name) for name in hand.split()]
+
+#random hands, plus ones from smaller decks so flushes, quads, and straight flushes come up too
+def getHands():
+    rng = random.Random(0)
+    decks = [
+        list(range(52)),
+        #two suits
+        [c for c in range(52) if c & 3 < 2],
+        #five ranks
+        list(range(20)),
+        #high clubs and some low cards, for straight flushes
+        [c for c in range(52) if c & 3 == 0 and c >> 2 >= 7 or c < 20],
+    ]
+    hands = []
+    for deck in decks:
+        for i in range(1500):
+            hands.append(rng.sample(deck, 7))
+    return hands
+
+def test_matchesBruteForce():
+    hands = getHands()
+    scores = [holdem.evaluate(hand) for hand in hands]
+    expected = [bruteForce(hand) for hand in hands]
+    #same order and same ties
+    scoreOf = {}
+    for score, brute in zip(scores, expected):
+        assert scoreOf.setdefault(brute, score) == score
+    bruteScores = sorted(scoreOf.items())
+    assert all(a[1] < b[1] for a, b in zip(bruteScores, bruteScores[1:]))
+    assert [holdem.getCategory(score) for score in scores] == [brute[0] for brute in expected]
+    #every category shows up
+    assert set(brute[0] for brute in expected) == set(range(len(holdem.CATEGORY_NAMES)))
+
+def test_evaluateBatch():
+    hands = getHands()
+    scores = holdem.evaluateBatch(np.array(hands))
+    assert list(scores) == [holdem.evaluate(hand) for hand in hands]
+
+def test_hands():
+    def category(hand):
+        return holdem.CATEGORY_NAMES[holdem.getCategory(holdem.evaluate(parse(hand)))]
+    assert category('Ac 2d 3h 4s 5c 9d Jh') == 'straight'
+    assert category('Ac 2c 3c 4c 5c 9d Jh') == 'straight flush'
+    assert category('Ah Kh Qh Jh Th 9h 8h') == 'straight flush'
+    assert category('2c 2d 2h 3s 3c 3d Ah') == 'full house'
+    assert category('2c 2d 2h 2s Ac Kd Qh') == 'four of a kind'
+    assert category('2c 4c 6c 8c Tc 3d 5h') == 'flush'
+    #the wheel loses to a 6 high straight
+    assert holdem.evaluate(parse('Ac 2d 3h 4s 5c Jd Qh')) < holdem.evaluate(parse('6c 2d 3h 4s 5c Jd Qh'))
+    #only the best 5 cards count
+    assert holdem.evaluate(parse('Ac Ad Kh Qs Jc 3d 2h')) == holdem.evaluate(parse('As Ah Kc Qd Js 4c 2d'))
+    assert holdem.evaluate(parse('Ac Ad Kh Qs Jc 3d 2h')) < holdem.evaluate(parse('As Ah Kc Qd Js Tc 2d'))
@@ -0,0 +1,86 @@
+import asyncio
+import numpy as np
+import pytest
+
+#inference and the agent need the full training environment
+pytest.importorskip('apex')
+
+import config
+import deepcfr
+import inference
+
+#the search process's cache of network outputs
+
+#returns fresh random outputs for every request, so a cached output can be told apart from a new one
+class FakeClient:
+    def __init__(self):
+        self.rng = np.random.default_rng(0)
+        self.requests = 0
+
+    async def predict(self, player, infoset):
+        await asyncio.sleep(0)
+        self.requests += 1
+        out = self.rng.normal(size=5)
+        return out[0:-1], out[-1]
+
+def getAgent(monkeypatch, cacheSize):
+    monkeypatch.setattr(config, 'predictCacheSize', cacheSize)
+    monkeypatch.setattr(config, 'pipelineTraining', False)
+    monkeypatch.setattr(config, 'inferenceTransport', 'gloo')
+    monkeypatch.setattr(config, 'transpositionTableSize', 0)
+    agent = deepcfr.DeepCfrAgent(writeLock=None, sharedDict=None, advModels=[None, None], singleDeep=True)
+    agent.inferenceClient = FakeClient()
+    return agent
+
+INFOSETS = [['start', 'hand', str(i % 3), 'OPTIONS'] for i in range(9)]
+
+def predictAll(agent, requests):
+    loop = asyncio.new_event_loop()
+    try:
+        return [loop.run_until_complete(agent.getPredict(player, infoset)) for player, infoset in requests]
+    finally:
+        loop.close()
+
+def test_sameOutputs(monkeypatch):
+    requests = [(i % 2, infoset) for i, infoset in enumerate(INFOSETS + INFOSETS)]
+    agent = getAgent(monkeypatch, 4096)
+    outs = predictAll(agent, requests)
+    #6 different (player, infoset) pairs
+    assert agent.inferenceClient.requests == 6
+    assert (agent.predictCache.hits, agent.predictCache.misses) == (12, 6)
+    #each pair always gets the output of its first request
+    first = {}
+    for (player, infoset), (advs, value) in zip(requests, outs):
+        expectedAdvs, expectedValue = first.setdefault((player, tuple(infoset)), (advs, value))
+        assert np.array_equal(advs, expectedAdvs) and value == expectedValue
+
+    uncached = getAgent(monkeypatch, 0)
+    predictAll(uncached, requests)
+    assert uncached.inferenceClient.requests == len(requests)
+    assert uncached.predictCache.hits + uncached.predictCache.misses == 0
+
+def test_invalidate(monkeypatch):
+    agent = getAgent(monkeypatch, 4096)
+    predictAll(agent, [(0, INFOSETS[0]), (1, INFOSETS[0])])
+    agent.predictCache.invalidate(0)
+    predictAll(agent, [(0, INFOSETS[0]), (1, INFOSETS[0])])
+    #only player 0's output had to be requested again
+    assert agent.inferenceClient.requests == 3
+
+def test_lru():
+    cache = inference.PredictCache(2)
+    keys = [cache.getKey(infoset) for infoset in INFOSETS[0:3]]
+    cache.put(0, keys[0], 'a')
+    cache.put(0, keys[1], 'b')
+    #using a makes b the oldest
+    assert cache.get(0, keys[0]) == 'a'
+    cache.put(0, keys[2], 'c')
+    assert cache.get(0, keys[1]) is None
+    assert cache.get(0, keys[0]) == 'a' and cache.get(0, keys[2]) == 'c'
+    assert cache.get(1, keys[0]) is None
+
+def test_keys():
+    cache = inference.PredictCache(2)
+    #joining the tokens can't make different infosets collide
+    assert cache.getKey(['ab', 'c']) != cache.getKey(['a', 'bc'])
+    assert cache.getKey(['a', 'b']) == cache.getKey(['a', 'b'])
@@ -0,0 +1,70 @@
+import pytest
+import random
+
+#model needs the full training environment
+pytest.importorskip('apex')
+import torch
+
+import config
+import games.warPoker
+import model
+
+#forward passes that reuse cached lstm states for infoset prefixes, against normal forward passes
+
+@pytest.fixture(autouse=True)
+def smallNet(monkeypatch):
+    monkeypatch.setattr(config, 'game', games.warPoker)
+    monkeypatch.setattr(config, 'embedSize', 8)
+    monkeypatch.setattr(config, 'lstmSize', 16)
+    monkeypatch.setattr(config, 'width', 16)
+    monkeypatch.setattr(config, 'enableCnn', False)
+    monkeypatch.setattr(config, 'enableAttention', False)
+    monkeypatch.setattr(config, 'prefixCacheSize', 64)
+    monkeypatch.setattr(config, 'prefixCacheChunk', 4)
+    torch.manual_seed(0)
+
+def getNet():
+    net = model.Net()
+    net.eval()
+    return net
+
+#infosets that grow like they do along a traversal, each one is an earlier one plus a few tokens
+#including ones shorter than a chunk and ones that end on a chunk boundary
+def getInfosets(rng, count):
+    infosets = [['start', 'hand', str(rng.randrange(2, 15))]]
+    while len(infosets) < count:
+        prev = rng.choice(infosets)
+        infosets.append(prev + [rng.choice(['0', '1']) for i in range(rng.randrange(1, 6))] + [rng.choice(['call', 'raise', 'fold'])])
+    return [model.infosetToTensor(infoset) for infoset in infosets]
+
+@pytest.mark.parametrize('numLayers', [1, 2])
+def test_sameOutputs(monkeypatch, numLayers):
+    monkeypatch.setattr(config, 'numLstmLayers', numLayers)
+    net = getNet()
+    prefixCache = model.PrefixCache(config.prefixCacheSize, config.prefixCacheChunk)
+    rng = random.Random(0)
+    infosets = getInfosets(rng, 60)
+    assert any(len(infoset) % config.prefixCacheChunk == 0 for infoset in infosets)
+    with torch.no_grad():
+        #the cache carries over between batches, like it does in the net process
+        for i in range(0, len(infosets), 10):
+            batch = infosets[i:i + 10]
+            cached = net.forwardCached(batch, prefixCache)
+            full = model.batchForward(net, batch, torch.device('cpu'))
+            assert torch.allclose(cached, full, atol=1e-5)
+    assert prefixCache.tokensSkipped > 0
+    assert len(prefixCache.states) <= config.prefixCacheSize
+
+#each network gets its own cache, and none while it's training
+def test_perNetwork():
+    net = getNet()
+    prefixCache = model.getPrefixCache(net)
+    assert prefixCache is model.getPrefixCache(net)
+    net.train()
+    assert model.getPrefixCache(net) is None
+    net.eval()
+    assert model.getPrefixCache(getNet()) is not prefixCache
+
+def test_needsPlainLstm(monkeypatch):
+    monkeypatch.setattr(config, 'enableAttention', True)
+    assert model.getPrefixCache(getNet()) is None
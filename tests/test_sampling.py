@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+
+import config
+import sampling
+
+#small deterministic checks of the sampling policies in sampling.py
+
+NUM_ACTIONS = 4
+PROBS = np.array([0.6, 0.3, 0.1, 0])
+REGRETS = np.array([0.5, 0.1, -0.5, -1, 0, 0])
+
+@pytest.fixture(autouse=True)
+def seed():
+    np.random.seed(0)
+
+def test_getPolicy(monkeypatch):
+    monkeypatch.setattr(config, 'samplingPolicy', 'robust')
+    assert isinstance(sampling.getPolicy(), sampling.RobustPolicy)
+    for name, policy in sampling.policies.items():
+        assert isinstance(sampling.getPolicy(name), policy)
+
+def test_fullWidth():
+    actionIndices, sampleProbs, pruned = sampling.FullWidthPolicy().select(PROBS, REGRETS, NUM_ACTIONS)
+    assert list(actionIndices) == list(range(NUM_ACTIONS))
+    assert np.array_equal(sampleProbs, np.ones(NUM_ACTIONS))
+    assert pruned == []
+
+def test_branching(monkeypatch):
+    monkeypatch.setattr(config, 'branchingLimit', 1)
+    monkeypatch.setattr(config, 'onExploreRate', 0.2)
+    policy = sampling.BranchingPolicy()
+    assert not policy.deterministic
+    counts = np.zeros(NUM_ACTIONS)
+    for i in range(10000):
+        actionIndices, sampleProbs, pruned = policy.select(PROBS, REGRETS, NUM_ACTIONS)
+        assert len(actionIndices) == 1 and pruned == []
+        counts[actionIndices[0]] += 1
+    expected = PROBS * 0.8 + 0.2 / NUM_ACTIONS
+    assert np.allclose(sampleProbs, expected)
+    assert np.allclose(counts / 10000, expected, atol=0.02)
+
+def test_branchingWithoutLimit(monkeypatch):
+    monkeypatch.setattr(config, 'branchingLimit', None)
+    policy = sampling.BranchingPolicy()
+    assert policy.deterministic
+    actionIndices, sampleProbs, pruned = policy.select(PROBS, REGRETS, NUM_ACTIONS)
+    assert list(actionIndices) == list(range(NUM_ACTIONS))
+    assert np.array_equal(sampleProbs, np.ones(NUM_ACTIONS))
+
+def test_pruning(monkeypatch):
+    monkeypatch.setattr(config, 'pruneThreshold', -0.25)
+    monkeypatch.setattr(config, 'pruneReexpandRate', 0)
+    policy = sampling.RegretPruningPolicy()
+    assert policy.deterministic
+    actionIndices, sampleProbs, pruned = policy.select(PROBS, REGRETS, NUM_ACTIONS)
+    assert actionIndices == [0, 1]
+    assert pruned == [2, 3]
+    assert np.array_equal(sampleProbs, [1, 1, 0, 0])
+
+def test_pruningKeepsBest(monkeypatch):
+    monkeypatch.setattr(config, 'pruneThreshold', -0.25)
+    monkeypatch.setattr(config, 'pruneReexpandRate', 0)
+    regrets = np.array([-2, -0.5, -1, -3])
+    actionIndices, sampleProbs, pruned = sampling.RegretPruningPolicy().select(PROBS, regrets, NUM_ACTIONS)
+    assert actionIndices == [1]
+    assert pruned == [0, 2, 3]
+
+def test_pruningReexpands(monkeypatch):
+    monkeypatch.setattr(config, 'pruneThreshold', -0.25)
+    monkeypatch.setattr(config, 'pruneReexpandRate', 0.1)
+    policy = sampling.RegretPruningPolicy()
+    assert not policy.deterministic
+    expanded = np.zeros(NUM_ACTIONS)
+    for i in range(10000):
+        actionIndices, sampleProbs, pruned = policy.select(PROBS, REGRETS, NUM_ACTIONS)
+        assert sorted(list(actionIndices) + pruned) == list(range(NUM_ACTIONS))
+        expanded[actionIndices] += 1
+    assert np.allclose(sampleProbs, [1, 1, 0.1, 0.1])
+    assert np.allclose(expanded / 10000, sampleProbs, atol=0.02)
+
+def test_robust(monkeypatch):
+    monkeypatch.setattr(config, 'robustSampleSize', 2)
+    counts = np.zeros(NUM_ACTIONS)
+    for i in range(10000):
+        actionIndices, sampleProbs, pruned = sampling.RobustPolicy().select(PROBS, REGRETS, NUM_ACTIONS)
+        assert len(set(actionIndices)) == 2 and pruned == []
+        counts[actionIndices] += 1
+    assert np.allclose(sampleProbs, 0.5)
+    assert np.allclose(counts / 10000, 0.5, atol=0.02)
+
+def test_average(monkeypatch):
+    monkeypatch.setattr(config, 'averageThreshold', 2)
+    monkeypatch.setattr(config, 'averageBonus', 0.1)
+    monkeypatch.setattr(config, 'averageEpsilon', 0.05)
+    counts = np.zeros(NUM_ACTIONS)
+    for i in range(10000):
+        actionIndices, sampleProbs, pruned = sampling.AverageStrategyPolicy().select(PROBS, REGRETS, NUM_ACTIONS)
+        counts[actionIndices] += 1
+    #0.6 is above 1 / threshold, and the 0 still gets bonus / (bonus + 1)
+    expected = [1, (0.1 + 0.6) / 1.1, (0.1 + 0.2) / 1.1, 0.1 / 1.1]
+    assert np.allclose(sampleProbs, expected)
+    assert np.allclose(counts / 10000, expected, atol=0.02)
+
+#cfrRecur divides the values of weighted policies' expanded actions by their odds
+#so on average the sum over expanded actions is the sum over every action
+@pytest.mark.parametrize('policy', [sampling.RobustPolicy, sampling.AverageStrategyPolicy])
+def test_weightedIsUnbiased(monkeypatch, policy):
+    monkeypatch.setattr(config, 'robustSampleSize', 1)
+    assert policy.weighted
+    values = np.array([1.0, -2.0, 3.0, 0.5])
+    total = 0
+    for i in range(20000):
+        actionIndices, sampleProbs, pruned = policy().select(PROBS, REGRETS, NUM_ACTIONS)
+        total += sum(values[j] / sampleProbs[j] for j in actionIndices)
+    assert abs(total / 20000 - np.sum(values)) < 0.1
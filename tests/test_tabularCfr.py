@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+import games.warPoker
+import tabularCfr
+
+#the tabular solver for warPoker, and that its tree is the same as the game's
+
+@pytest.mark.parametrize('mode', ['cfr', 'cfr+', 'dcfr'])
+def test_converges(mode):
+    solver = tabularCfr.Solver(mode)
+    reports = solver.solve(1000, reportInterval=250)
+    exploitabilities = [exploitability for iteration, exploitability, seconds in reports]
+    assert exploitabilities[-1] < exploitabilities[0]
+    assert exploitabilities[-1] < 0.001
+    assert all(exploitability > -1e-9 for exploitability in exploitabilities)
+
+def test_values():
+    uniform = tabularCfr.getUniformStrategy()
+    assert tabularCfr.getExploitability(uniform) > 0.1
+    values = tabularCfr.getValues(uniform)
+    assert values[0] == pytest.approx(-values[1])
+
+    #every mode finds the same game value
+    gameValues = []
+    for mode in ['cfr', 'cfr+', 'dcfr']:
+        solver = tabularCfr.Solver(mode)
+        solver.solve(1000)
+        values = tabularCfr.getValues(solver.getAverageStrategy())
+        assert values[0] == pytest.approx(-values[1])
+        gameValues.append(values[0])
+    assert np.ptp(gameValues) < 1e-3
+    #a best response can't do worse than the strategy it replaces
+    strategy = solver.getAverageStrategy()
+    bestResponse = tabularCfr.getBestResponseValues(strategy)
+    assert bestResponse[0] >= gameValues[-1] - 1e-9
+    assert bestResponse[1] >= -gameValues[-1] - 1e-9
+
+#plays every history of warPoker games and compares the infosets, actions, trajectories, and payoffs
+def walk(game, history):
+    player, req, actions = game.getTurnSync()
+    #role 0 is the player who isn't the dealer
+    role = 0 if player != game.dealer else 1
+    roleCards = [game.hands[(game.dealer + 1) % 2] - 2, game.hands[game.dealer] - 2]
+    if 'win' in req:
+        isShowdown, payoff = tabularCfr.TERMINALS[history]
+        if isShowdown:
+            payoff *= np.sign(roleCards[0] - roleCards[1])
+        assert (req['win'] if role == 0 else -1 * req['win']) == payoff
+        return 1
+
+    assert tabularCfr.NODES[history][0] == role
+    card = roleCards[role]
+    assert game.getInfoset(player) == tabularCfr.getInfoset(card, history)
+    assert actions == tabularCfr.getActions(history)
+    assert game.prevTrajectories[player] == tabularCfr.getTrajectory(card, history)
+    terminals = 0
+    for i, action in enumerate(tabularCfr.NODES[history][1]):
+        child = game.fork()
+        child.takeActionSync(player, i)
+        terminals += walk(child, history + action)
+    return terminals
+
+@pytest.mark.parametrize('seed', [0.1, 0.2, 0.3, 0.4])
+def test_matchesWarPoker(seed):
+    game = games.warPoker.Game(seed=seed, saveTrajectories=True)
+    game.startGameSync()
+    #the dealer deals first
+    player, req, actions = game.getTurnSync()
+    game.takeActionSync(player, 0)
+    assert walk(game, '') == len(tabularCfr.TERMINALS)
@@ -0,0 +1,101 @@
+import asyncio
+import hashlib
+import numpy as np
+import pytest
+
+#the agent needs the full training environment
+pytest.importorskip('apex')
+
+import config
+import deepcfr
+import games.warPoker
+import model
+
+#cfrRecur with and without the transposition table, on warPoker with fake networks
+
+#deterministic advantages and value for each infoset, in place of the net process
+class FakeClient:
+    async def predict(self, player, infoset):
+        await asyncio.sleep(0)
+        digest = hashlib.blake2b(('%d\0' % player + '\0'.join(infoset)).encode('UTF-8'), digest_size=8).digest()
+        out = np.random.default_rng(int.from_bytes(digest, 'little')).normal(size=games.warPoker.numActions + 1)
+        return out[0:-1], out[-1]
+
+@pytest.fixture(autouse=True)
+def warPoker(monkeypatch):
+    monkeypatch.setattr(config, 'game', games.warPoker)
+    monkeypatch.setattr(config, 'gameName', 'warPoker')
+    monkeypatch.setattr(config, 'inferenceTransport', 'gloo')
+    monkeypatch.setattr(config, 'samplingPolicy', 'fullWidth')
+    monkeypatch.setattr(config, 'offPlayerFullWidth', True)
+    monkeypatch.setattr(config, 'depthLimit', None)
+    monkeypatch.setattr(config, 'enableProbingRollout', False)
+    monkeypatch.setattr(config, 'pipelineTraining', False)
+    monkeypatch.setattr(config, 'predictCacheSize', 0)
+    monkeypatch.setattr(config, 'sampleCacheSize', 10 ** 9)
+    #getAgent sets this, so the fixture puts it back afterwards
+    monkeypatch.setattr(config, 'transpositionTableSize', 0)
+
+def getAgent(tableSize):
+    config.transpositionTableSize = tableSize
+    advModels = [model.DeepCfrModel(name='adv' + str(i), softmax=False, writeLock=None, sharedDict=None, useNet=False) for i in range(2)]
+    agent = deepcfr.DeepCfrAgent(writeLock=None, sharedDict=None, advModels=advModels, singleDeep=True)
+    agent.inferenceClient = FakeClient()
+    return agent
+
+#like DeepCfrAgent.traverse, but returns the value
+async def traverse(agent, iter, seed):
+    context = games.warPoker.getContext()
+    game = config.game.Game(context=context, seed=seed, history=[[],[]])
+    await game.startGame()
+    return await agent.cfrRecur(context, game, seed, [[],[]], iter)
+
+#values and samples from traversing each seed in order
+#repeated seeds deal the same hands, so they hit the table
+def run(agent, iter, seeds):
+    loop = asyncio.new_event_loop()
+    try:
+        values = [loop.run_until_complete(traverse(agent, iter, seed)) for seed in seeds]
+    finally:
+        loop.close()
+    samples = sorted((s[0].numpy().tobytes(), s[1].tobytes(), s[2].tobytes()) for s in agent.advModels[iter % 2].sampleCache)
+    return values, samples
+
+SEEDS = [0.1, 0.2, 0.1, 0.3, 0.2, 0.1]
+
+@pytest.mark.parametrize('iter', [1, 2])
+def test_exact(iter):
+    agent = getAgent(1000)
+    assert agent.replayTranspositions
+    values, samples = run(agent, iter, SEEDS)
+    assert agent.transpositions.hits > 0
+    expectedValues, expectedSamples = run(getAgent(0), iter, SEEDS)
+    assert values == expectedValues
+    assert samples == expectedSamples
+
+#with a depth limit, a hit reuses the value but not the samples
+def test_valuesOnly(monkeypatch):
+    monkeypatch.setattr(config, 'depthLimit', 100)
+    agent = getAgent(1000)
+    assert not agent.replayTranspositions
+    values, samples = run(agent, 1, SEEDS)
+    assert agent.transpositions.hits > 0
+    expectedValues, expectedSamples = run(getAgent(0), 1, SEEDS)
+    assert values == expectedValues
+    assert len(samples) < len(expectedSamples)
+    assert set(samples) <= set(expectedSamples)
+
+def test_maxSize():
+    table = deepcfr.TranspositionTable(2)
+    for i in range(3):
+        table.put(i, (i, None))
+    assert table.get(0) == (0, None)
+    assert table.get(2) is None
+    assert (table.hits, table.misses) == (1, 1)
+    table.clear()
+    assert table.get(0) is None
+
+def test_needsDeterminedState(monkeypatch, capsys):
+    monkeypatch.setattr(games.warPoker, 'infosetsDetermineState', False)
+    assert getAgent(1000).transpositions is None
+    assert "infosets don't determine the game state" in capsys.readouterr().err